@@ -1,4 +1,5 @@
 import getpass
+import json
 import os
 
 from nbgrader.api import Gradebook
@@ -8,10 +9,16 @@ from nbgrader.api import Gradebook
 
 c = get_config()  # noqa
 
-NBG_STUDENTS = []
 COURSE_NAME_SHORT = os.environ['MOODLECOURSE']
 NBG_USER_DIR = f'/home/{getpass.getuser()}/nbgrader'
 GRADEBOOK_DB = f'sqlite:///{NBG_USER_DIR}/{COURSE_NAME_SHORT}/gradebook.db'
+# 受講者一覧はJupyterHubがコースディレクトリに出力する
+NBG_STUDENTS_FILE = f'{NBG_USER_DIR}/{COURSE_NAME_SHORT}/nbgrader_students.json'
+
+NBG_STUDENTS = []
+if os.path.isfile(NBG_STUDENTS_FILE):
+    with open(NBG_STUDENTS_FILE, encoding='utf-8') as f:
+        NBG_STUDENTS = json.load(f)
 
 gb = Gradebook(GRADEBOOK_DB, COURSE_NAME_SHORT, None)
 
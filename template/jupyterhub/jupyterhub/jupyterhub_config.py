@@ -1,21 +1,37 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import copy
 from enum import Enum
+import functools
+import hashlib
+import json
 import logging
 import os
 import pwd
+import random
 import secrets
 import shutil
+import stat
 import string
 import sys
+import tempfile
 import requests
 import yaml
+from jupyterhub.log import CoroutineLogFormatter
 from ldap3 import MODIFY_REPLACE
 
+from lms_client import get_lms_client
 from lms_web_service import get_course_students_by_lms_api
-from lti import confirm_key_exist, get_lms_lti_token
-from utils import ldapClient
+from lti import LTI_TOKEN_CACHE_FILE, LtiTokenManager, NrpsMembers, confirm_key_exist
+from metrics import SpawnPhase, observe_spawn_phase, spawn_labels
+from utils import (JsonFormatter, RateLimitFilter, SuppressedCountMixin,
+                   TextFormatter, TTLCache, ldapClient)
 
 LOG_FORMAT = '[%(levelname)s %(asctime)s %(module)s %(funcName)s:%(lineno)d] %(message)s'
+# JupyterHub自身のログの形式(JupyterHubの既定と同じ)
+HUB_LOG_FORMAT = '%(color)s[%(levelname)1.1s %(asctime)s.%(msecs).03d %(name)s %(module)s:%(lineno)d]%(end_color)s %(message)s'
+HUB_LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
 CONTEXTLEVEL_COURSE = 50
 IMS_LTI13_FQDN = 'purl.imsglobal.org'
 IMS_LTI_CLAIM_BASE = f'https://{IMS_LTI13_FQDN}/spec/lti/claim'
@@ -31,18 +47,22 @@ DEFUALT_IDLE_TIMEOUT = 1800
 DEFUALT_CULL_EVERY = 60
 DEFUALT_SERVER_MAX_AGE = 0
 DEFUALT_COOKIE_MAX_AGE_DAYS = 0.25
+DEFAULT_ROSTER_CACHE_TTL = 300
+DEFAULT_LOG_LEVEL = 'INFO'
+# ログの形式(text/json)
+DEFAULT_LOG_FORMAT = 'text'
+DEFAULT_LOG_RATE_LIMIT_PERIOD = 60
+DEFAULT_LOG_RATE_LIMIT_MAX_RECORDS = 100
+DEFAULT_NRPS_PAGE_LIMIT = 1000
+DEFAULT_PROVISION_WORKERS = 16
+OWNER_DRIFT_SAMPLE_SIZE = 64
+SKELETON_MANIFEST_FILE = '.skeleton_manifest.json'
+SKELETON_MANIFEST_TTL = 60
+SKELETON_COPY_WORKERS = 8
 
 HOME_DIR_ROOT = '/home'
 SHARE_DIR_ROOT = '/jupytershare'
 
-# -- logger setting --
-logger = logging.getLogger()
-handler = logging.StreamHandler(sys.stdout)
-handler.setLevel(logging.DEBUG)
-log_formatter = logging.Formatter(LOG_FORMAT)
-handler.setFormatter(log_formatter)
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
 
 jupyterhub_fqdn = os.environ['JUPYTERHUB_FQDN']
 jupyterhub_admin_users = os.getenv('JUPYTERHUB_ADMIN_USERS')
@@ -66,11 +86,46 @@ lms_api_token = os.getenv('LMS_API_TOKEN')
 HOME_DIR_ROOT_HOST = os.environ['HOME_DIR_ROOT']
 SHARE_DIR_ROOT_HOST = os.environ['SHARE_DIR_ROOT']
 skelton_directory = os.path.join(HOME_DIR_ROOT_HOST, 'skelton')
+# スケルトンディレクトリのファイル一覧のキャッシュ
+skeleton_manifest_cache = TTLCache(ttl=SKELETON_MANIFEST_TTL)
 email_domain = os.getenv('EMAIL_DOMAIN', 'example.com')
 
 with open('/etc/jupyterhub/jupyterhub_params.yaml', 'r', encoding="utf-8") as yml:
     config = yaml.safe_load(yml)
 
+
+class HubTextFormatter(SuppressedCountMixin, CoroutineLogFormatter):
+    """JupyterHub自身のログをテキストで出力する"""
+
+
+# -- logger setting --
+log_config = config.get('logging') or dict()
+log_level = logging.getLevelName(
+    str(log_config.get('level', DEFAULT_LOG_LEVEL)).upper())
+if not isinstance(log_level, int):
+    raise ValueError(f'Invalid log level: {log_config["level"]}')
+log_rate_limit_config = log_config.get('rate_limit') or dict()
+log_rate_limit = dict(
+    period=log_rate_limit_config.get('period', DEFAULT_LOG_RATE_LIMIT_PERIOD),
+    max_records=log_rate_limit_config.get(
+        'max_records', DEFAULT_LOG_RATE_LIMIT_MAX_RECORDS),
+)
+
+logger = logging.getLogger()
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(log_level)
+log_format = str(log_config.get('format', DEFAULT_LOG_FORMAT)).lower()
+if log_format not in ('text', 'json'):
+    raise ValueError(f'Invalid log format: {log_config["format"]}')
+if log_format == 'json':
+    log_formatter = JsonFormatter()
+else:
+    log_formatter = TextFormatter(LOG_FORMAT)
+handler.setFormatter(log_formatter)
+handler.addFilter(RateLimitFilter(**log_rate_limit))
+logger.addHandler(handler)
+logger.setLevel(log_level)
+
 c = get_config() # type: ignore # noqa
 
 c.Authenticator.allow_all = True
@@ -140,8 +195,26 @@ c.JupyterHub.shutdown_on_logout = True
 # Whether to shutdown single-user servers when the Hub shuts down.
 c.JupyterHub.cleanup_servers = True
 
-# debug-logging for testing
-c.JupyterHub.log_level = logging.DEBUG
+c.JupyterHub.log_level = log_level
+# JupyterHub自身のログにもjupyterhub_params.yamlの形式・流量制限を適用する
+c.JupyterHub.logging_config = {
+    'filters': {
+        'rate_limit': {'()': RateLimitFilter, **log_rate_limit},
+    },
+    'handlers': {
+        'console': {'filters': ['rate_limit']},
+    },
+}
+if log_format == 'json':
+    c.JupyterHub.logging_config['formatters'] = {'json': {'()': JsonFormatter}}
+    c.JupyterHub.logging_config['handlers']['console']['formatter'] = 'json'
+else:
+    c.JupyterHub.logging_config['formatters'] = {'text': {
+        '()': HubTextFormatter,
+        'fmt': HUB_LOG_FORMAT,
+        'datefmt': HUB_LOG_DATEFMT,
+    }}
+    c.JupyterHub.logging_config['handlers']['console']['formatter'] = 'text'
 
 # Whole system resource restrictions.
 # Maximum number of concurrent named servers that can be created by a user at a time.
@@ -177,6 +250,10 @@ c.LTI13Authenticator.authorize_url = f'{c.LTI13Authenticator.issuer}/mod/lti/aut
 c.LTI13Authenticator.jwks_endpoint = f'{c.LTI13Authenticator.issuer}/mod/lti/certs.php'
 token_endpoint = f'{c.LTI13Authenticator.issuer}/mod/lti/token.php'
 private_key, public_key = confirm_key_exist()
+lti_token_manager = LtiTokenManager(jupyterhub_fqdn,
+                                    private_key,
+                                    token_endpoint,
+                                    os.environ['LMS_CLIENT_ID'])
 
 service_teachertools_name = "teachertools"
 service_teachertools_port = 8088
@@ -197,7 +274,8 @@ c.JupyterHub.services.append(
             HOME_DIR_ROOT_HOST,
         ],
         'environment': {'LDAP_PASSWORD': os.environ['LDAP_PASSWORD'],
-                        'LDAP_SERVER': ldap_server}
+                        'LDAP_SERVER': ldap_server,
+                        'LTI_TOKEN_CACHE_FILE': LTI_TOKEN_CACHE_FILE}
     }
 )
 # Permission for service
@@ -260,7 +338,24 @@ c.SwarmSpawner.extra_placement_spec = {
 # launch timeout
 c.SwarmSpawner.start_timeout = 300
 
-nrps_token = None
+# コースの受講者一覧のキャッシュ
+# キーはLMSのコンテキストID(コースID)
+roster_cache_config = config.get('roster_cache') or dict()
+roster_cache = TTLCache(ttl=roster_cache_config.get(
+    'ttl', DEFAULT_ROSTER_CACHE_TTL))
+roster_force_refresh = roster_cache_config.get(
+    'instructor_force_refresh', False)
+# NRPSで1ページあたりに取得するメンバー数
+nrps_page_limit = roster_cache_config.get(
+    'nrps_page_limit', DEFAULT_NRPS_PAGE_LIMIT)
+# NRPSの差分取得に使う前回の取得結果
+# キーはメンバーシップサービスのURL
+nrps_rosters = dict()
+
+# auth_state_hookでLDAP・LMSへの通信やファイル操作を行うスレッド
+provision_executor = ThreadPoolExecutor(
+    max_workers=config.get('provision_workers', DEFAULT_PROVISION_WORKERS),
+    thread_name_prefix='provision')
 
 
 class McjRoles(Enum):
@@ -369,19 +464,226 @@ class FailedAuthStateHookException(McjException):
 
 
 def confirm_dir(path, mode=0o700, uid=-1, gid=-1):
+    """ディレクトリを作成し、権限と所有者を設定する
+
+    ログインの度に呼ばれるため、既に指定の権限・所有者であれば変更しない。
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        os.makedirs(path, exist_ok=True)
+        st = os.stat(path)
+
+    if stat.S_IMODE(st.st_mode) != mode:
+        os.chmod(path, mode=mode)
+    if (uid != -1 and st.st_uid != uid) or (gid != -1 and st.st_gid != gid):
+        os.chown(path, uid, gid)
+
 
-    os.makedirs(path, exist_ok=True)
-    os.chmod(path, mode=mode)
-    os.chown(path, uid, gid)
+def write_file_if_changed(path, content: bytes, mode=0o644, uid=-1, gid=-1):
+    """内容が変わる場合のみファイルを書き換える
+
+    同じディレクトリに一時ファイルを作成し、所有者と権限を設定してから
+    置き換えるため、読み込み側が書きかけのファイルを見ることはない。
+
+    :param path: 書き込み先のファイルパス
+    :type path: str
+    :param content: ファイルの内容
+    :type content: bytes
+    :returns: ファイルを書き換えた場合はTrue
+    :rtype: bool
+    """
+    try:
+        with open(path, 'rb') as f:
+            current_digest = hashlib.sha256(f.read()).digest()
+    except FileNotFoundError:
+        current_digest = None
+
+    if current_digest == hashlib.sha256(content).digest():
+        return False
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            os.fchown(f.fileno(), uid, gid)
+            os.fchmod(f.fileno(), mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+def get_skeleton_manifest(src):
+    """スケルトンディレクトリのファイル一覧とバージョンを返す
+
+    各ファイルはサイズと更新日時で識別し、その一覧のハッシュ値をバージョンとする。
+
+    :returns: (バージョン, {相対パス: 識別子})
+    :rtype: tuple
+    """
+    files = dict()
+    for root, dirs, names in os.walk(src):
+        for name in names:
+            p = os.path.join(root, name)
+            st = os.stat(p)
+            files[os.path.relpath(p, src)] = f'{st.st_size}-{st.st_mtime_ns}'
+    version = hashlib.sha256(
+        json.dumps(files, sort_keys=True).encode('utf-8')).hexdigest()
+    return version, files
+
+
+def copy_file_with_owner(src, dst, uid, gid):
+    """所有者と権限を設定しながらファイルをコピーする
+
+    一時ファイルに書き込んでから置き換える。コピーはカーネル内で行い、
+    対応するファイルシステムではデータを複製せずに共有(reflink)する。
+
+    :returns: コピー先のstat
+    :rtype: os.stat_result
+    """
+    with open(src, 'rb') as fsrc:
+        src_st = os.fstat(fsrc.fileno())
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst),
+                                        prefix=f'.{os.path.basename(dst)}.')
+        try:
+            with os.fdopen(fd, 'wb') as fdst:
+                os.fchown(fdst.fileno(), uid, gid)
+                os.fchmod(fdst.fileno(), stat.S_IMODE(src_st.st_mode))
+                try:
+                    remaining = src_st.st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(fsrc.fileno(),
+                                                    fdst.fileno(), remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                except OSError:
+                    # copy_file_rangeに対応しないファイルシステムの場合
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+                    shutil.copyfileobj(fsrc, fdst)
+                fdst.flush()
+                dst_st = os.fstat(fdst.fileno())
+            os.replace(tmp_path, dst)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return dst_st
+
+
+def copy_skeleton(src, dst, uid, gid):
+    """スケルトンディレクトリをコピーする
+
+    コピー先にはコピーしたファイルとスケルトンのバージョンを記録したマニフェストを置き、
+    スケルトンが更新された場合は変更されたファイルのみをコピーする。
+    コピー後に利用者が変更・削除したファイル、マニフェスト導入前からあるファイルは上書きしない。
+    ファイルは利用者が編集するため、ハードリンクでの共有はしない。
+
+    :param src: スケルトンディレクトリ
+    :type src: str
+    :param dst: コピー先ディレクトリ
+    :type dst: str
+    """
+    version, src_files = skeleton_manifest_cache.get_or_load(
+        src, lambda: get_skeleton_manifest(src))
+
+    manifest_path = os.path.join(dst, SKELETON_MANIFEST_FILE)
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        manifest = dict(version=None, files=dict())
+    if manifest['version'] == version:
+        return
+
+    targets = list()
+    for relpath, source in src_files.items():
+        try:
+            st = os.lstat(os.path.join(dst, relpath))
+        except FileNotFoundError:
+            st = None
+        entry = manifest['files'].get(relpath)
+        if entry is None:
+            if st is None:
+                targets.append(relpath)
+        elif entry['source'] != source and st is not None and \
+                (entry['size'], entry['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+            targets.append(relpath)
+
+    confirm_dir(dst, mode=0o755, uid=uid, gid=gid)
+    for d in sorted({os.path.dirname(relpath) for relpath in targets}):
+        if d:
+            confirm_dir(os.path.join(dst, d), mode=0o755, uid=uid, gid=gid)
+
+    def _copy(relpath):
+        return copy_file_with_owner(os.path.join(src, relpath),
+                                    os.path.join(dst, relpath), uid, gid)
+
+    with ThreadPoolExecutor(max_workers=SKELETON_COPY_WORKERS) as executor:
+        for relpath, st in zip(targets, executor.map(_copy, targets)):
+            manifest['files'][relpath] = dict(source=src_files[relpath],
+                                              size=st.st_size,
+                                              mtime_ns=st.st_mtime_ns)
+    if targets:
+        logger.info(f'Copied {len(targets)} skeleton files to {dst}')
+    else:
+        logger.debug(f'No skeleton files to copy to {dst}')
+
+    manifest['version'] = version
+    write_file_if_changed(manifest_path,
+                          json.dumps(manifest, indent=1).encode('utf-8'),
+                          uid=uid, gid=gid)
 
 
 def change_owner(homePath, uid, gid):
+    """homePath以下の所有者を再帰的に変更する。所有者が一致するものは変更しない"""
+    def _chown(path, st):
+        if st.st_uid != uid or st.st_gid != gid:
+            os.lchown(path, uid, gid)
+
     for root, dirs, files in os.walk(homePath):
-        for d in dirs:
-            os.chown(os.path.join(root, d), uid, gid)
-        for f in files:
-            os.chown(os.path.join(root, f), uid, gid)
-    os.chown(homePath, uid, gid)
+        for name in dirs + files:
+            p = os.path.join(root, name)
+            _chown(p, os.lstat(p))
+    _chown(homePath, os.lstat(homePath))
+
+
+def has_owner_drift(path, uid, gid, sample_size=OWNER_DRIFT_SAMPLE_SIZE):
+    """path以下に所有者がuid:gidでないものがあるかを簡易的に確認する
+
+    path自身と直下の全エントリに加え、直下のディレクトリから無作為に選んだ
+    最大sample_size件のエントリを確認する。全件は確認しないため、
+    見落としがあってもエラーとはせず、次回以降のログインで検出する。
+    """
+    def _drifted(st):
+        return st.st_uid != uid or st.st_gid != gid
+
+    if _drifted(os.lstat(path)):
+        return True
+
+    subdirs = list()
+    with os.scandir(path) as it:
+        for entry in it:
+            if _drifted(entry.stat(follow_symlinks=False)):
+                return True
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+
+    checked = 0
+    random.shuffle(subdirs)
+    for subdir in subdirs:
+        with os.scandir(subdir) as it:
+            for entry in it:
+                if _drifted(entry.stat(follow_symlinks=False)):
+                    return True
+                checked += 1
+                if checked >= sample_size:
+                    return False
+    return False
 
 
 def get_random_password(size=12):
@@ -395,23 +697,6 @@ def get_random_password(size=12):
     return password
 
 
-def set_permission_recursive(path: str, mode = None,
-                             uid: int = -1, gid: int = -1):
-
-    for root, dirs, files in os.walk(path):
-        for d in dirs:
-            p = os.path.join(root, d)
-            if mode is not None:
-                os.chmod(p, mode)
-            os.chown(p, uid, gid)
-
-        for f in files:
-            p = os.path.join(root, f)
-            if mode is not None:
-                os.chmod(p, mode)
-            os.chown(p, uid, gid)
-
-
 def get_user_mounts(course_name: str, role):
 
     mounts = dict()
@@ -485,53 +770,112 @@ def confirm_share_dir(role, root_uid_num, user_name,
                     gid=gid_teachers)
 
 
-def get_nrps_token():
-    return get_lms_lti_token(IMS_LTI13_NRPS_TOKEN_SCOPE,
-                             jupyterhub_fqdn,
-                             private_key,
-                             token_endpoint,
-                             os.environ['LMS_CLIENT_ID'])
-
-
-def get_course_students_by_nrps(url, default_key='user_id'):
-
-    global nrps_token
-    if nrps_token is None:
-        nrps_token = get_nrps_token()
-        logger.info('Created LMS access token')
-    headers = {'Authorization': f'Bearer {nrps_token}'}
-    response = requests.get(
+def nrps_get(url, **kwargs):
+    """LMSのアクセストークンを付与してGETする。トークンが拒否されれば作り直す"""
+    headers = kwargs.pop('headers', dict())
+    with observe_spawn_phase(SpawnPhase.TOKEN_FETCH):
+        token = lti_token_manager.get_token(IMS_LTI13_NRPS_TOKEN_SCOPE)
+    response = get_lms_client().get(
         url,
-        headers=headers,
-        timeout=30
-    )
+        headers={**headers, 'Authorization': f'Bearer {token}'},
+        **kwargs)
     if response.status_code == 401:
 
         logger.info('LMS access token expired')
-        nrps_token = get_nrps_token()
+        with observe_spawn_phase(SpawnPhase.TOKEN_FETCH):
+            token = lti_token_manager.get_token(IMS_LTI13_NRPS_TOKEN_SCOPE,
+                                                invalid_token=token)
         logger.info('LMS access token successfully recreated')
-        headers = {'Authorization': f'Bearer {nrps_token}'}
-        response = requests.get(
+        response = get_lms_client().get(
             url,
-            headers=headers,
-            timeout=30
-        )
+            headers={**headers, 'Authorization': f'Bearer {token}'},
+            **kwargs)
+    return response
+
+
+def nrps_member_to_student(member, default_key='user_id'):
+    """NRPSのメンバー情報を受講者情報に変換する。受講者でなければNoneを返す"""
+    if not member.get('status', 'Active') == 'Active' or \
+       'Learner' not in member.get('roles', list()):
+        return None
+
+    return dict(
+        id=member.get('ext_user_username', member[default_key]),
+        first_name=member.get('given_name'),
+        last_name=member.get('family_name'),
+        email=member.get('email'),
+        lms_user_id=member['user_id'])
+
+
+def get_course_students_by_nrps(url, default_key='user_id'):
+    """NRPSでコースの受講者一覧を取得する
 
-    students = list()
-    for member in response.json().get('members'):
-        if not member['status'] == 'Active' or 'Learner' not in member['roles']:
-            continue
+    前回の取得でLMSから差分取得用のURL(differences)が返されていれば、
+    前回からの変更分のみを取得して反映する。
 
-        user_id = member.get('ext_user_username', member[default_key])
+    :param url: メンバーシップサービスのURL
+    :type url: str
+    """
+    roster = nrps_rosters.get(url)
+    if roster is not None and roster['differences_url'] is not None:
+        members = NrpsMembers(roster['differences_url'], nrps_get,
+                              limit=nrps_page_limit)
+        try:
+            students = dict(roster['students'])
+            for member in members:
+                student = nrps_member_to_student(member, default_key)
+                if student is None:
+                    students.pop(member['user_id'], None)
+                else:
+                    students[member['user_id']] = student
+        except requests.exceptions.RequestException as e:
+            logger.warning(
+                f'Failed to get course members difference, fetch all: {e}')
+        else:
+            logger.info(f'Updated course members by difference: '
+                        f'{members.pages} pages')
+            roster = dict(students=students,
+                          differences_url=members.differences_url)
+            nrps_rosters[url] = roster
+            return list(roster['students'].values())
+
+    members = NrpsMembers(url, nrps_get, limit=nrps_page_limit)
+    students = dict()
+    for member in members:
+        student = nrps_member_to_student(member, default_key)
+        if student is not None:
+            students[member['user_id']] = student
+    logger.info(f'Fetched course members: {members.pages} pages')
+
+    nrps_rosters[url] = dict(students=students,
+                             differences_url=members.differences_url)
+    return list(students.values())
+
+
+def get_course_students(auth_state, force_refresh=False):
+    """コースの受講者一覧をLMSから取得する
+
+    同じコースの取得結果はroster_cacheの有効期間内で共有し、
+    同時に複数の取得要求があった場合もLMSへのリクエストは1度にまとめる。
+    """
+    course_id = auth_state[IMS_LTI13_KEY_MEMBER_CONTEXT]['id']
+
+    def _fetch():
+        logger.info(f'Fetch course members from LMS: {course_id}')
+        if get_course_member_method == 'moodle_api':
+            return get_course_students_by_lms_api(
+                lms_api_token,
+                course_id,
+                c.LTI13Authenticator.issuer)
+        elif c.LTI13Authenticator.username_key == 'email':
+            return get_course_students_by_nrps(
+                auth_state[IMS_LTI13_KEY_NRPS]['context_memberships_url'],
+                default_key='email')
+        else:
+            return get_course_students_by_nrps(
+                auth_state[IMS_LTI13_KEY_NRPS]['context_memberships_url'])
 
-        students.append(
-            dict(
-                id=user_id,
-                first_name=member.get('given_name'),
-                last_name=member.get('family_name'),
-                email=member.get('email'),
-                lms_user_id=member['user_id']))
-    return students
+    return roster_cache.get_or_load(course_id, _fetch, force=force_refresh)
 
 
 def confirm_nbgrader_dir(course_name,
@@ -576,6 +920,8 @@ def confirm_nbgrader_dir(course_name,
         course_source_dir = os.path.join(course_dir, 'source')
         course_submitted_dir = os.path.join(course_dir, 'submitted')
         course_config_file = os.path.join(course_dir, 'nbgrader_config.py')
+        course_students_file = os.path.join(course_dir,
+                                            'nbgrader_students.json')
         cource_header_file = os.path.join(course_source_dir, 'header.ipynb')
         cource_autotests_yml = os.path.join(course_dir, 'autotests.yml')
 
@@ -598,20 +944,17 @@ def confirm_nbgrader_dir(course_name,
         confirm_dir(course_submitted_dir, mode=0o0755, uid=user_uid_num,
                     gid=groupid)
 
-        with open(config_template_file, encoding="utf-8") as f1:
-            target_lines = f1.read()
-
-        target_lines = target_lines.replace(
-            'NBG_STUDENTS = []', f"NBG_STUDENTS = {str(students)}")
-
-        if os.path.exists(course_config_file):
-            os.remove(course_config_file)
-
-        with open(course_config_file, mode="w", encoding="utf-8") as f2:
-            f2.write(target_lines)
+        with open(config_template_file, 'rb') as f:
+            write_file_if_changed(course_config_file, f.read(),
+                                  uid=user_uid_num, gid=groupid)
 
-        os.chown(course_config_file, user_uid_num, groupid)
-        os.chmod(course_config_file, 0o0644)
+        # 受講者の並び順だけが変わった場合に書き換えないよう、IDで整列する
+        students_json = json.dumps(
+            sorted(students, key=lambda student: str(student['id'])),
+            ensure_ascii=False, indent=1, sort_keys=True)
+        write_file_if_changed(course_students_file,
+                              students_json.encode('utf-8'),
+                              uid=user_uid_num, gid=groupid)
 
         if not os.path.isfile(cource_header_file):
 
@@ -625,7 +968,8 @@ def confirm_nbgrader_dir(course_name,
             os.chown(cource_autotests_yml, user_uid_num, groupid)
             os.chmod(cource_autotests_yml, 0o0644)
 
-        if os.path.exists(instructor_log_file):
+        if os.path.isfile(instructor_log_file) and \
+           os.path.getsize(instructor_log_file) > 0:
             fp = open(instructor_log_file, 'r+', encoding="utf-8")
             fp.truncate(0)
             fp.close()
@@ -633,88 +977,124 @@ def confirm_nbgrader_dir(course_name,
             os.chmod(instructor_log_file, 0o0644)
 
 
-def auth_state_hook(spawner, auth_state):
+@functools.lru_cache(maxsize=None)
+def get_root_uid_num():
+    try:
+        root_obj = pwd.getpwnam("root")
+    except KeyError as e:
+        logger.error("Could not find root in passwd.")
+        raise e
 
-    if not auth_state:
-        return
+    return int(root_obj[2])
 
-    lms_username = auth_state[IMS_LTI13_KEY_MEMBER_EXT]['user_username']
-    lms_course_shortname = auth_state[IMS_LTI13_KEY_MEMBER_CONTEXT]['label']
-    lms_role = McjRoles.get_user_role(auth_state[IMS_LTI13_KEY_MEMBER_ROLES])
-    homedir_host = os.path.join(HOME_DIR_ROOT_HOST, lms_username)
-    homedir_container = os.path.join(HOME_DIR_ROOT, lms_username)
-    uid_num = int(auth_state['sub']) + 1000
-    gid_num = role_config[lms_role]['gid_num']
+
+def confirm_ldap_user(lms_username, lms_role, uid_num, gid_num,
+                      homedir_container):
+    """LDAPにユーザを登録する。登録済みであればグループを更新する"""
 
     ldapconn = ldapClient(ldap_server, ldap_manager_dn, ldap_password)
-    search_result = ldapconn.search_user(lms_username, ['uidNumber'])
+    with observe_spawn_phase(SpawnPhase.LDAP_SEARCH):
+        search_result = ldapconn.search_user(lms_username, ['uidNumber'])
 
     if search_result is None:
-        ldapconn.add_user(
-            f'uid={lms_username},{ldap_base_dn}',
-            ['posixAccount', 'inetOrgPerson'],
-            {
-                'uid': lms_username,
-                'cn': lms_username,
-                'sn': lms_username,
-                'uidNumber': uid_num,
-                'gidNumber': gid_num,
-                'homeDirectory': homedir_container,
-                'loginShell': role_config[lms_role]['login_shell'],
-                'userPassword': get_random_password(12),
-                'mail': f'{lms_username}@{email_domain}',
-            },
-        )
+        with observe_spawn_phase(SpawnPhase.LDAP_ADD):
+            ldapconn.add_user(
+                f'uid={lms_username},{ldap_base_dn}',
+                ['posixAccount', 'inetOrgPerson'],
+                {
+                    'uid': lms_username,
+                    'cn': lms_username,
+                    'sn': lms_username,
+                    'uidNumber': uid_num,
+                    'gidNumber': gid_num,
+                    'homeDirectory': homedir_container,
+                    'loginShell': role_config[lms_role]['login_shell'],
+                    'userPassword': get_random_password(12),
+                    'mail': f'{lms_username}@{email_domain}',
+                },
+            )
     else:
-        ldapconn.update_user(lms_username,
-                             {'gidNumber': [(MODIFY_REPLACE, [gid_num])]})
+        with observe_spawn_phase(SpawnPhase.LDAP_MODIFY):
+            ldapconn.update_user(lms_username,
+                                 {'gidNumber': [(MODIFY_REPLACE, [gid_num])]})
+
+
+def confirm_home_dir(lms_role, homedir_host, uid_num, gid_num):
 
-    # ホームディレクトリ作成
     confirm_dir(homedir_host, mode=0o755, uid=uid_num, gid=gid_num)
     if lms_role == McjRoles.INSTRUCTOR.value:
-        shutil.copy(os.path.join(skelton_directory, 'README.md'),
-                    homedir_host)
-        tools_dir = os.path.join(homedir_host, 'teacher_tools')
-        if not os.path.isdir(tools_dir):
-            shutil.copytree(os.path.join(skelton_directory, 'teacher_tools'),
-                            tools_dir)
-            set_permission_recursive(tools_dir, uid=uid_num)
+        with open(os.path.join(skelton_directory, 'README.md'), 'rb') as f:
+            write_file_if_changed(os.path.join(homedir_host, 'README.md'),
+                                  f.read(), uid=uid_num, gid=gid_num)
+        copy_skeleton(os.path.join(skelton_directory, 'teacher_tools'),
+                      os.path.join(homedir_host, 'teacher_tools'),
+                      uid_num, gid_num)
 
-    try:
-        root_obj = pwd.getpwnam("root")
-    except KeyError as e:
-        logger.error("Could not find root in passwd.")
-        raise e
+    # コンテナ起動時に再帰的にchownすると、ファイル数の多いホームディレクトリでは
+    # 起動に時間がかかるため、所有者のずれを検出した場合のみここで修正する
+    if has_owner_drift(homedir_host, uid_num, gid_num):
+        logger.info(f'Fix owner of home directory: {homedir_host}')
+        change_owner(homedir_host, uid_num, gid_num)
 
-    root_uid_num = int(root_obj[2])
-    # root_gid_num = int(root_obj[3])
 
-    confirm_share_dir(
-        lms_role,
-        root_uid_num,
-        lms_username,
-        uid_num,
-        lms_course_shortname,
-    )
+async def auth_state_hook(spawner, auth_state):
 
-    students = list()
-    if get_course_member_method == 'moodle_api':
-        students = get_course_students_by_lms_api(
-            lms_api_token,
-            auth_state[IMS_LTI13_KEY_MEMBER_CONTEXT]['id'],
-            c.LTI13Authenticator.issuer)
-    elif c.LTI13Authenticator.username_key == 'email':
-        students = get_course_students_by_nrps(
-            auth_state[IMS_LTI13_KEY_NRPS]['context_memberships_url'],
-            default_key='email')
-    else:
-        students = get_course_students_by_nrps(
-            auth_state[IMS_LTI13_KEY_NRPS]['context_memberships_url'])
+    if not auth_state:
+        return
+
+    lms_username = auth_state[IMS_LTI13_KEY_MEMBER_EXT]['user_username']
+    lms_course_shortname = auth_state[IMS_LTI13_KEY_MEMBER_CONTEXT]['label']
+    lms_role = McjRoles.get_user_role(auth_state[IMS_LTI13_KEY_MEMBER_ROLES])
+    homedir_host = os.path.join(HOME_DIR_ROOT_HOST, lms_username)
+    homedir_container = os.path.join(HOME_DIR_ROOT, lms_username)
+    uid_num = int(auth_state['sub']) + 1000
+    gid_num = role_config[lms_role]['gid_num']
 
-    confirm_nbgrader_dir(
-        lms_course_shortname, lms_role, lms_username,
-        root_uid_num, uid_num, gid_num,
-        students)
+    # 計測値のラベル。provision_executorで実行する処理にも引き継ぐ
+    spawn_labels.set(dict(role=lms_role, course=lms_course_shortname))
+
+    # LDAP・LMSへの通信やファイル操作はイベントループを止めないよう、
+    # provision_executorのスレッドで実行する
+    loop = asyncio.get_running_loop()
+
+    def run_in_executor(phase, func, *args, **kwargs):
+        def _run():
+            if phase is None:
+                return func(*args, **kwargs)
+            with observe_spawn_phase(phase):
+                return func(*args, **kwargs)
+        return loop.run_in_executor(provision_executor,
+                                    contextvars.copy_context().run, _run)
+
+    with observe_spawn_phase(SpawnPhase.AUTH_STATE_HOOK):
+        root_uid_num = await run_in_executor(None, get_root_uid_num)
+
+        # 互いに依存しない処理は並行して行う
+        tasks = [
+            run_in_executor(None, confirm_ldap_user, lms_username, lms_role,
+                            uid_num, gid_num, homedir_container),
+            # ホームディレクトリ作成
+            run_in_executor(SpawnPhase.HOME_DIR, confirm_home_dir, lms_role,
+                            homedir_host, uid_num, gid_num),
+            run_in_executor(SpawnPhase.SHARE_DIR, confirm_share_dir, lms_role,
+                            root_uid_num, lms_username, uid_num,
+                            lms_course_shortname),
+        ]
+        # 受講者一覧は教師のnbgrader設定にのみ利用する
+        if lms_role == McjRoles.INSTRUCTOR.value:
+            tasks.append(run_in_executor(SpawnPhase.ROSTER_FETCH,
+                                         get_course_students, auth_state,
+                                         force_refresh=roster_force_refresh))
+        results = await asyncio.gather(*tasks)
+        students = results[3] if lms_role == McjRoles.INSTRUCTOR.value \
+            else list()
+
+        await run_in_executor(
+            SpawnPhase.NBGRADER_DIR,
+            confirm_nbgrader_dir,
+            lms_course_shortname, lms_role, lms_username,
+            root_uid_num, uid_num, gid_num,
+            students)
 
     spawner.environment = {
         'MOODLECOURSE': lms_course_shortname,
@@ -733,8 +1113,6 @@ def auth_state_hook(spawner, auth_state):
         'NB_GID': gid_num,
         'HOME': homedir_container,
         'CHOWN_HOME': 'yes',
-        'CHOWN_EXTRA': f'{homedir_container}',
-        'CHOWN_EXTRA_OPTS': '-R',
     }
     if os.getenv('ENABLE_CUSTOM_SETUP'):
         spawner.environment['ENABLE_CUSTOM_SETUP'] = 'yes'
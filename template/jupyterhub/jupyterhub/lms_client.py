@@ -0,0 +1,209 @@
+from http import HTTPStatus
+import re
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import LMS_REQUEST_DURATION_SECONDS, LMS_REQUEST_ERRORS
+
+
+# 接続プールを保持するホスト数
+LMS_POOL_CONNECTIONS = 4
+# ホストごとに保持する接続数の上限
+LMS_POOL_MAXSIZE = 16
+# (接続, 読み込み)のタイムアウト秒数
+LMS_TIMEOUT = (5, 30)
+LMS_MAX_RETRIES = 3
+LMS_RETRY_BACKOFF_FACTOR = 1
+LMS_RETRY_STATUS = (
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.INTERNAL_SERVER_ERROR,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT,
+)
+# 再送するHTTPメソッド。再送で処理が重複しないよう冪等なメソッドに限る。
+# POST(成績の送信など)を再送する場合は呼び出し元で行うこと
+LMS_RETRY_METHODS = Retry.DEFAULT_ALLOWED_METHODS
+# エンドポイント名でIDとみなすパスの要素(数字のみ、UUID、16桁以上の16進数)
+ENDPOINT_ID_PATTERN = re.compile(
+    r'\d+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'
+    r'|[0-9a-fA-F]{16,}')
+
+
+def normalize_endpoint(url: str) -> str:
+    """URLから、metricsに記録するエンドポイント名を作成する
+
+    クエリ文字列を除き、コースIDやlineitem IDなどのIDとみなすパスの要素を{id}に置き換える。
+
+    >>> normalize_endpoint('https://lms.example.com/mod/lti/services.php/2/lineitems/15/lineitem/scores?type_id=1')
+    'https://lms.example.com/mod/lti/services.php/{id}/lineitems/{id}/lineitem/scores'
+    >>> normalize_endpoint('https://lms.example.com/mod/lti/services.php/CourseSection/2/bindings/1/memberships')
+    'https://lms.example.com/mod/lti/services.php/CourseSection/{id}/bindings/{id}/memberships'
+
+    :param url: URL
+    :type url: str
+    :returns: エンドポイント名
+    :rtype: str
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = '/'.join(
+        '{id}' if ENDPOINT_ID_PATTERN.fullmatch(segment) else segment
+        for segment in parts.path.split('/'))
+    return parts._replace(path=path, query='', fragment='').geturl()
+
+
+class LmsMetrics():
+    """LMSへのリクエストの所要時間をエンドポイントごとに集計する
+
+    集計結果はprometheus_clientの既定のレジストリ(metrics.LMS_REQUEST_DURATION_SECONDS、
+    metrics.LMS_REQUEST_ERRORS)にも記録する。複数スレッドから利用できる。
+    """
+
+    def __init__(self):
+        self._data = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, method: str, endpoint: str, elapsed: float,
+                error: bool = False):
+        key = (method, endpoint)
+        with self._lock:
+            item = self._data.setdefault(
+                key, dict(count=0, errors=0, total_sec=0.0, max_sec=0.0))
+            item['count'] += 1
+            item['errors'] += int(error)
+            item['total_sec'] += elapsed
+            item['max_sec'] = max(item['max_sec'], elapsed)
+        LMS_REQUEST_DURATION_SECONDS.labels(
+            method=method, endpoint=endpoint).observe(elapsed)
+        if error:
+            LMS_REQUEST_ERRORS.labels(method=method, endpoint=endpoint).inc()
+
+    def snapshot(self) -> list:
+        """集計結果を返す
+
+        :returns: method, endpoint, count, errors, total_sec, max_sec, avg_secを持つdictのリスト
+        :rtype: list
+        """
+        with self._lock:
+            items = [dict(method=method, endpoint=endpoint, **item)
+                     for (method, endpoint), item in self._data.items()]
+        for item in items:
+            item['avg_sec'] = item['total_sec'] / item['count']
+        return items
+
+
+class LmsClient():
+    """LMSへのHTTPリクエストを送信する
+
+    ホストごとに接続プールを持つrequests.Sessionを共有し、TCP/TLS接続を再利用する。
+    タイムアウトと再送の方針を統一し、エンドポイントごとの所要時間をmetricsに記録する。
+    requests.Sessionは複数スレッドから同時に利用できるため、
+    非同期処理からはrun_in_executorで呼び出すこと。
+
+    :param pool_connections: 接続プールを保持するホスト数
+    :type pool_connections: int
+    :param pool_maxsize: ホストごとに保持する接続数の上限
+    :type pool_maxsize: int
+    :param timeout: 既定のタイムアウト秒数。(接続, 読み込み)のタプルも指定できる
+    :type timeout: float | tuple
+    :param max_retries: 429/5xxの応答や接続エラーの場合に再送する回数。
+                        再送はLMS_RETRY_METHODSのメソッドのみ行う
+    :type max_retries: int
+    :param backoff_factor: 再送間隔の係数。n回目の再送はbackoff_factor * 2 ** (n - 1)秒後
+    :type backoff_factor: float
+    """
+
+    def __init__(self,
+                 pool_connections: int = LMS_POOL_CONNECTIONS,
+                 pool_maxsize: int = LMS_POOL_MAXSIZE,
+                 timeout: float | tuple = LMS_TIMEOUT,
+                 max_retries: int = LMS_MAX_RETRIES,
+                 backoff_factor: float = LMS_RETRY_BACKOFF_FACTOR):
+        self.timeout = timeout
+        self.metrics = LmsMetrics()
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=LMS_RETRY_STATUS,
+            allowed_methods=LMS_RETRY_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method: str, url: str, endpoint: str | None = None,
+                **kwargs) -> requests.Response:
+        """リクエストを送信する
+
+        :param method: HTTPメソッド
+        :type method: str
+        :param url: URL
+        :type url: str
+        :param endpoint: metricsに記録するエンドポイント名。
+                         Noneの場合はURLから作成する(normalize_endpoint)
+        :type endpoint: str
+        :param kwargs: requests.Session.requestに渡す引数
+        """
+        if endpoint is None:
+            endpoint = normalize_endpoint(url)
+        kwargs.setdefault('timeout', self.timeout)
+
+        start = time.monotonic()
+        error = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            error = response.status_code >= HTTPStatus.BAD_REQUEST
+            return response
+        finally:
+            self.metrics.observe(method.upper(), endpoint,
+                                 time.monotonic() - start, error=error)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+
+_lms_client = None
+_lms_client_lock = threading.Lock()
+
+
+def configure_lms_client(**kwargs) -> LmsClient:
+    """プロセス内で共有するLmsClientを指定した設定で作成する
+
+    接続プール・タイムアウト・再送の設定はこのLmsClientに集約し、
+    LTIのトークン取得(lti.py)とAGS・NRPSのリクエストで同じ接続プールを使う。
+    既定の設定を変える場合は、起動時にget_lms_clientより前に呼び出すこと。
+
+    :param kwargs: LmsClientに渡す引数
+    :returns: 作成したLmsClient
+    :rtype: LmsClient
+    """
+    global _lms_client
+    with _lms_client_lock:
+        _lms_client = LmsClient(**kwargs)
+        return _lms_client
+
+
+def get_lms_client() -> LmsClient:
+    """プロセス内で共有するLmsClientを返す
+
+    configure_lms_clientを呼び出していない場合は既定の設定で作成する。
+    """
+    global _lms_client
+    with _lms_client_lock:
+        if _lms_client is None:
+            _lms_client = LmsClient()
+        return _lms_client
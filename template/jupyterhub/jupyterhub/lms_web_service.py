@@ -1,6 +1,7 @@
-import requests
 import urllib
 
+from lms_client import get_lms_client
+
 
 def get_course_students_by_lms_api(token, courseid, iss):
 
@@ -15,10 +16,11 @@ def get_course_students_by_lms_api(token, courseid, iss):
         "content-type": "application/json"
     }
     params = urllib.parse.urlencode(params)
-    response = requests.get(
+    response = get_lms_client().get(
         url,
         headers=headers,
         params=params,
+        endpoint=f'{url}?wsfunction=core_enrol_get_enrolled_users',
     )
 
     students = list()
@@ -1,15 +1,33 @@
+import fcntl
+import json
 import jwt
+import logging
 import os
-import requests
+import tempfile
+import threading
 import time
-import urllib
+import urllib.parse
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
+from lms_client import get_lms_client
+
 
 IMS_LTI13_NRPS_ASSERT_TYPE = 'urn:ietf:params:oauth:client-assertion-type:jwt-bearer'
+IMS_LTI13_NRPS_MEDIA_TYPE = 'application/vnd.ims.lti-nrps.v2.membershipcontainer+json'
+# JupyterHubとteachertoolsサービスで共有するアクセストークンの保存先
+# LMSのBearerトークンを平文で保存するため、JupyterHubの実行ユーザのみが
+# 読み書きできるディレクトリを指定すること(ファイル自体は0600で作成する)
+LTI_TOKEN_CACHE_FILE = os.getenv('LTI_TOKEN_CACHE_FILE',
+                                 '/srv/jupyterhub/lti_tokens.json')
+# 有効期限のこの秒数前になったらアクセストークンを再発行する
+LTI_TOKEN_REFRESH_MARGIN_SEC = 60
+# LMSが有効期限を返さない場合に想定する有効期間
+LTI_TOKEN_DEFAULT_EXPIRES_IN = 3600
+
+logger = logging.getLogger(__name__)
 
 
 def generate_keypair() -> bytes:
@@ -80,20 +98,23 @@ def create_lti_jwt(tool_url, private_key, token_endpoint, client_id):
         "aud": token_endpoint,
         "sub": client_id
     }
-    print(f'Expire: {current_unix_time + 60 * 10}')
+    logger.debug('Create LTI JWT: expire=%d', token_value['exp'])
     return jwt.encode(
         token_value, private_key, algorithm="RS256")
 
 
-def get_lms_lti_token(scopes: str | list, tool_url, private_key, token_endpoint, client_id) -> str:
-
+def scopes_to_str(scopes: str | list) -> str:
     # scopeはスペース区切りで指定する
     if str == type(scopes):
-        _scopes = scopes
+        return scopes
     elif list == type(scopes) or tuple == type(scopes):
-        _scopes = ' '.join(scopes)
+        return ' '.join(scopes)
     else:
-        _scopes = scopes
+        return scopes
+
+
+def request_lms_lti_token(scopes: str | list, tool_url, private_key, token_endpoint, client_id) -> dict:
+    """LMSのトークンエンドポイントからアクセストークンを取得し、応答をそのまま返す"""
 
     jwt = create_lti_jwt(tool_url, private_key, token_endpoint, client_id)
 
@@ -101,23 +122,204 @@ def get_lms_lti_token(scopes: str | list, tool_url, private_key, token_endpoint,
         'grant_type': 'client_credentials',
         'client_assertion_type': IMS_LTI13_NRPS_ASSERT_TYPE,
         'client_assertion': jwt,
-        'scope': _scopes,
+        'scope': scopes_to_str(scopes),
     }
     data = urllib.parse.urlencode(data)
     headers = {
         'Content-Type': 'application/x-www-form-urlencoded',
     }
 
-    response = requests.post(
+    response = get_lms_client().post(
         token_endpoint,
         headers=headers,
         data=data,
-        timeout=30
     )
 
     if 200 != response.status_code:
-        print(response.text)
+        # 応答本文にはトークンが含まれ得るため、ステータスコードのみ記録する
+        logger.debug('Failed to get LTI token: status=%d', response.status_code)
         raise Exception("Failed to get nrps token from LMS. Public key in outer tool settings in LMS may be wrong")
 
-    return response.json()['access_token']
+    return response.json()
+
+
+def get_lms_lti_token(scopes: str | list, tool_url, private_key, token_endpoint, client_id) -> str:
+
+    return request_lms_lti_token(scopes, tool_url, private_key,
+                                 token_endpoint, client_id)['access_token']
+
+
+class LtiTokenManager():
+    """LMSのアクセストークンをスコープの組み合わせごとに保持する
+
+    有効期限の少し前に再発行するため、期限切れによるリクエストの失敗を待たずに済む。
+    再発行はスレッド間ではロック、プロセス間ではcache_fileのファイルロックで
+    1度にまとめ、取得したトークンはcache_fileに保存して他のプロセスと共有する。
+    cache_fileに書き込めない場合は、プロセス内でのみ保持する。
+
+    :param tool_url: ツールのURL(JWTのiss)
+    :type tool_url: str
+    :param private_key: JWTの署名に使う秘密鍵
+    :param token_endpoint: LMSのトークンエンドポイント
+    :type token_endpoint: str
+    :param client_id: LMSに登録したツールのクライアントID
+    :type client_id: str
+    :param cache_file: アクセストークンの保存先
+    :type cache_file: str
+    :param refresh_margin: 有効期限の何秒前に再発行するか
+    :type refresh_margin: int
+    """
+
+    def __init__(self, tool_url, private_key, token_endpoint, client_id,
+                 cache_file: str | None = LTI_TOKEN_CACHE_FILE,
+                 refresh_margin: int = LTI_TOKEN_REFRESH_MARGIN_SEC):
+        self.tool_url = tool_url
+        self.private_key = private_key
+        self.token_endpoint = token_endpoint
+        self.client_id = client_id
+        self.cache_file = cache_file
+        self.refresh_margin = refresh_margin
+        self._tokens = dict()
+        self._lock = threading.Lock()
+
+    def _cache_key(self, scopes: str | list) -> str:
+        scope_set = ' '.join(sorted(set(scopes_to_str(scopes).split())))
+        return f'{self.client_id} {self.token_endpoint} {scope_set}'
+
+    def _is_valid(self, token: dict | None, invalid_token: str | None) -> bool:
+        return token is not None and \
+            token['access_token'] != invalid_token and \
+            token['expires_at'] - self.refresh_margin > time.time()
+
+    def _read_cache_file(self) -> dict:
+        try:
+            with open(self.cache_file, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _write_cache_file(self, tokens: dict):
+        now = time.time()
+        tokens = {key: token for key, token in tokens.items()
+                  if token['expires_at'] > now}
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.cache_file),
+            prefix=f'.{os.path.basename(self.cache_file)}.')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                os.fchmod(f.fileno(), 0o0600)
+                json.dump(tokens, f)
+            os.replace(tmp_path, self.cache_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _open_lock_file(self):
+        if self.cache_file is None:
+            return None
+        try:
+            fd = os.open(f'{self.cache_file}.lock',
+                         os.O_RDWR | os.O_CREAT, 0o0600)
+        except OSError:
+            return None
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def get_token(self, scopes: str | list, invalid_token: str | None = None) -> str:
+        """アクセストークンを返す。有効期限が近ければ再発行する
+
+        :param scopes: スコープ
+        :type scopes: str | list
+        :param invalid_token: LMSに拒否されたアクセストークン。
+                              保持しているトークンと同じであれば再発行する
+        :type invalid_token: str
+        :returns: アクセストークン
+        :rtype: str
+        """
+        key = self._cache_key(scopes)
+        token = self._tokens.get(key)
+        if self._is_valid(token, invalid_token):
+            return token['access_token']
+
+        with self._lock:
+            token = self._tokens.get(key)
+            if self._is_valid(token, invalid_token):
+                return token['access_token']
+
+            lock_fd = self._open_lock_file()
+            try:
+                tokens = self._read_cache_file() if lock_fd is not None \
+                    else dict()
+                token = tokens.get(key)
+                if not self._is_valid(token, invalid_token):
+                    response = request_lms_lti_token(
+                        scopes, self.tool_url, self.private_key,
+                        self.token_endpoint, self.client_id)
+                    token = dict(
+                        access_token=response['access_token'],
+                        expires_at=time.time() + int(response.get(
+                            'expires_in', LTI_TOKEN_DEFAULT_EXPIRES_IN)))
+                    tokens[key] = token
+                    if lock_fd is not None:
+                        try:
+                            self._write_cache_file(tokens)
+                        except OSError:
+                            # 保存できなくても取得したトークンは使えるため、処理は続ける
+                            logger.warning('Failed to save LMS access token',
+                                           exc_info=True)
+            finally:
+                if lock_fd is not None:
+                    os.close(lock_fd)
+
+            self._tokens[key] = token
+            return token['access_token']
+
+
+class NrpsMembers():
+    """NRPSのメンバー一覧をページ単位で取得しながら1件ずつ返す
+
+    Linkヘッダのrel="next"をたどって全ページを取得する。
+    保持するのは取得中の1ページ分のみのため、受講者数によらずメモリ使用量が抑えられる。
+    最終ページにrel="differences"があれば、差分取得用のURLとしてdifferences_urlに保持する。
+
+    :param url: メンバーシップサービスのURL(context_memberships_urlまたはdifferencesのURL)
+    :type url: str
+    :param request_get: LmsClient.getと同じ引数を受け取り、レスポンスを返す関数
+    :type request_get: callable
+    :param limit: 1ページあたりの取得件数。Noneの場合はLMSの既定値
+    :type limit: int
+    """
+
+    def __init__(self, url: str, request_get, limit: int | None = None):
+        self.url = url
+        self.request_get = request_get
+        self.limit = limit
+        self.differences_url = None
+        self.pages = 0
+
+    def __iter__(self):
+        url = self.url
+        if self.limit:
+            parsed = urllib.parse.urlparse(url)
+            query = urllib.parse.parse_qs(parsed.query)
+            if 'limit' not in query:
+                query['limit'] = [str(self.limit)]
+                url = parsed._replace(
+                    query=urllib.parse.urlencode(query, doseq=True)).geturl()
+
+        while url:
+            response = self.request_get(
+                url,
+                headers={'Accept': IMS_LTI13_NRPS_MEDIA_TYPE})
+            response.raise_for_status()
+            self.pages += 1
+
+            links = response.links
+            if 'differences' in links:
+                self.differences_url = links['differences']['url']
+
+            members = response.json().get('members') or list()
+            del response
+            yield from members
 
+            url = links.get('next', dict()).get('url')
@@ -0,0 +1,64 @@
+from contextlib import contextmanager
+import contextvars
+import time
+
+from prometheus_client import Counter, Histogram
+
+
+# JupyterHubの/metricsで公開される(prometheus_clientの既定のレジストリに登録する)
+SPAWN_PHASE_DURATION_SECONDS = Histogram(
+    'mcj_spawn_phase_duration_seconds',
+    'Time spent in each phase of provisioning a user before spawn',
+    ['phase', 'role', 'course'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+             float('inf')),
+)
+
+# LMSへのリクエストの所要時間・エラー数(lms_client.LmsMetrics)
+# teachertoolsサービスでの計測値は/services/teachertools/metricsで公開される
+# endpointはURLからID部分を除いたテンプレート(lms_client.normalize_endpoint)
+LMS_REQUEST_DURATION_SECONDS = Histogram(
+    'mcj_lms_request_duration_seconds',
+    'Time spent in requests to the LMS, including retries',
+    ['method', 'endpoint'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf')),
+)
+LMS_REQUEST_ERRORS = Counter(
+    'mcj_lms_request_errors_total',
+    'Requests to the LMS which failed or returned 4xx/5xx',
+    ['method', 'endpoint'],
+)
+
+
+class SpawnPhase():
+    LDAP_SEARCH = 'ldap_search'
+    LDAP_ADD = 'ldap_add'
+    LDAP_MODIFY = 'ldap_modify'
+    TOKEN_FETCH = 'token_fetch'
+    ROSTER_FETCH = 'roster_fetch'
+    HOME_DIR = 'home_dir'
+    SHARE_DIR = 'share_dir'
+    NBGRADER_DIR = 'nbgrader_dir'
+    AUTH_STATE_HOOK = 'auth_state_hook'
+
+
+# 計測値に付けるロール・コース名
+# run_in_executorで実行する処理に引き継ぐ場合は、contextvars.copy_context()を使うこと
+spawn_labels = contextvars.ContextVar('spawn_labels',
+                                      default=dict(role='', course=''))
+
+
+@contextmanager
+def observe_spawn_phase(phase: str):
+    """withブロックの所要時間をphaseの処理時間として記録する
+
+    :param phase: SpawnPhaseの値
+    :type phase: str
+    """
+    labels = spawn_labels.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPAWN_PHASE_DURATION_SECONDS.labels(phase=phase, **labels).observe(
+            time.perf_counter() - start)
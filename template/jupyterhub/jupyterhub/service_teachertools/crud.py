@@ -1,6 +1,7 @@
 from typing import Any
 
 from sqlmodel import Session, select, delete
+from sqlalchemy import case
 from sqlalchemy.dialects import (sqlite, postgresql, mysql,
                                  oracle, mssql)
 
@@ -11,12 +12,25 @@ from models import (Student,
                     CellUpdate,
                     Log,
                     LogCreate,
-                    LogUpdate)
+                    LogUpdate,
+                    LatestLog,
+                    LatestLogCreate,
+                    ScanState,
+                    ScanStateCreate)
+
+
+# 1文のINSERTにまとめる行数
+UPSERT_CHUNK_SIZE = 500
 
 
 def upsert(session: Session, table: Any, values: list[dict],
-           index_elements: list[str]):
+           index_elements: list[str], update_columns: list[str] = None,
+           chunk_size: int = UPSERT_CHUNK_SIZE, newer_column: str = None):
     """update or ignoreを実行する
+
+    UPSERT_CHUNK_SIZE行ごとに複数行のINSERT文として発行する。
+    update_columnsの指定が無い場合、既存の行は更新しない。
+    newer_columnを指定した場合、その列の値が既存の行より大きい場合のみ更新する。
     """
 
     dialect_map = {
@@ -26,10 +40,39 @@ def upsert(session: Session, table: Any, values: list[dict],
         "postgresql": postgresql,
         "sqlite": sqlite,
     }
-    insert_stmt = dialect_map[session.bind.dialect.name].insert(table).values(values)
-    do_nothing_stmt = insert_stmt.on_conflict_do_nothing(
-        index_elements=index_elements)
-    session.exec(do_nothing_stmt)
+    dialect_name = session.bind.dialect.name
+    columns = table.__table__.c
+    for i in range(0, len(values), chunk_size):
+        insert_stmt = dialect_map[dialect_name].insert(table).values(
+            values[i:i + chunk_size])
+        if dialect_name == "mysql":
+            # MySQL/MariaDBはON CONFLICT句を持たない
+            if update_columns and newer_column:
+                # 左の列から順に代入されるため、比較に使う列は最後に更新する
+                # (順序を保つため、dictではなくタプルのリストで指定する)
+                is_newer = columns[newer_column] < insert_stmt.inserted[newer_column]
+                set_ = [(c, case((is_newer, insert_stmt.inserted[c]),
+                                 else_=columns[c]))
+                        for c in update_columns if c != newer_column]
+                set_.append((newer_column, case(
+                    (is_newer, insert_stmt.inserted[newer_column]),
+                    else_=columns[newer_column])))
+                stmt = insert_stmt.on_duplicate_key_update(set_)
+            elif update_columns:
+                stmt = insert_stmt.on_duplicate_key_update(
+                    {c: insert_stmt.inserted[c] for c in update_columns})
+            else:
+                stmt = insert_stmt.prefix_with("IGNORE")
+        elif update_columns:
+            stmt = insert_stmt.on_conflict_do_update(
+                index_elements=index_elements,
+                set_={c: insert_stmt.excluded[c] for c in update_columns},
+                where=(columns[newer_column] < insert_stmt.excluded[newer_column]
+                       if newer_column else None))
+        else:
+            stmt = insert_stmt.on_conflict_do_nothing(
+                index_elements=index_elements)
+        session.exec(stmt)
 
 
 def create_students(*, session: Session, students_create: list[StudentCreate],
@@ -50,7 +93,6 @@ def create_students(*, session: Session, students_create: list[StudentCreate],
         upsert(session, Student,
                [student_create.to_dict() for student_create in students_create], ["id"])
 
-    session.commit()
     return db_obj_list
 
 
@@ -147,3 +189,63 @@ def delete_logs(*, session: Session, assignment: str = None,
 
 def delete_log_all(*, session: Session) -> Any:
     session.exec(select(Log)).delete()
+
+
+def update_latest_logs(*, session: Session,
+                       latest_logs_create: list[LatestLogCreate]) -> Any:
+    """学生・セルごとの最新のログを登録・更新する
+
+    登録済みの行よりlog_sequenceが大きい場合のみ更新する。
+    """
+    upsert(session, LatestLog,
+           [latest_log_create.to_dict() for latest_log_create in latest_logs_create],
+           ["assignment", "student_id", "cell_id"],
+           update_columns=["log_sequence", "log_execute_reply_status",
+                           "log_start", "log_end"],
+           newer_column="log_sequence")
+
+
+def delete_latest_logs(*, session: Session, keys: list[tuple]) -> Any:
+    """学生・セルごとの最新のログを削除する
+
+    ログファイルが作り直された場合に、作り直す前のログを最新として残さないために使う。
+
+    :param keys: (課題名, 学生名, セルID)のリスト
+    :type keys: list
+    """
+    for assignment, student_id, cell_id in keys:
+        session.exec(delete(LatestLog).where(
+            LatestLog.assignment == assignment,
+            LatestLog.student_id == student_id,
+            LatestLog.cell_id == cell_id))
+
+
+def get_progress(*, session: Session, assignment: str
+                 ) -> tuple[list[str], list[Cell], list[LatestLog]]:
+    """課題の進捗状況の作成に必要な学生・セル・最新のログを返す
+
+    セルはノートブック名、セルIDの順に並べる。
+    """
+    students = session.exec(select(Student.id).order_by(Student.id)).all()
+    cells = session.exec(
+        select(Cell).where(Cell.assignment == assignment)
+        .order_by(Cell.notebook_name, Cell.id)).all()
+    latest_logs = session.exec(
+        select(LatestLog).where(LatestLog.assignment == assignment)).all()
+    return students, cells, latest_logs
+
+
+def get_scan_states(*, session: Session) -> dict[str, ScanState]:
+    """ログファイルの取り込み状況をパスをキーとした辞書で返す
+    """
+    return {row.path: row for row in session.exec(select(ScanState))}
+
+
+def update_scan_states(*, session: Session,
+                       scan_states_create: list[ScanStateCreate]) -> Any:
+    """ログファイルの取り込み状況を登録・更新する
+    """
+    upsert(session, ScanState,
+           [scan_state_create.to_dict() for scan_state_create in scan_states_create],
+           ["path"],
+           update_columns=["mtime_ns", "size", "log_sequence", "log_offset"])
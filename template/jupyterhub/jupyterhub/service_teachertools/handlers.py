@@ -1,26 +1,38 @@
-from datetime import datetime, timezone
+import asyncio
+import codecs
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import functools
 import glob
+import hashlib
 from http import HTTPStatus
 import json
 import logging
 import os
 import re
 import requests
+import threading
 
 from jupyterhub.services.auth import HubAuthenticated, HubOAuthenticated
 from jupyterhub.utils import url_path_join
 from jinja2 import Environment
 from nbgrader.api import Gradebook, MissingEntry
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from pydantic import ValidationError
 from tornado import escape, web
-from sqlmodel import Session, create_engine
-
-from lti import get_lms_lti_token, confirm_key_exist
-from models import LineItem, Score, init_db, StudentCreate, CellCreate, LogCreate
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from sqlmodel import Session
+
+from lms_client import LMS_RETRY_STATUS
+from lti import LtiTokenManager, confirm_key_exist
+from models import (LineItem, Score, init_db, get_engine, StudentCreate,
+                    CellCreate, LogCreate, LatestLogCreate, ScanStateCreate)
 import crud
 from nbgrader_utils import (get_course_assignments, get_grades,
                             db_path, get_course_students)
-from utils import ldapClient
+from utils import TTLCache, ldapClient
 
 
 require_scopes = (
@@ -30,17 +42,36 @@ require_scopes = (
     'https://purl.imsglobal.org/spec/lti-ags/scope/score',
 )
 course_info_key = 'https://purl.imsglobal.org/spec/lti/claim/context'
-lms_token = None
 private_key, _ = confirm_key_exist()
+lti_token_managers = dict()
+# username -> uidNumber
+uid_cache = TTLCache(ttl=600)
 
 
 DEFAULT_DT_FROM = datetime(1970, 1, 1, tzinfo=timezone.utc)
+LOG_SCAN_WORKERS = 8
+# ログファイルを読み取る単位(バイト)
+LOG_READ_CHUNK_SIZE = 64 * 1024
+AGS_RETRY_BACKOFF_SEC = 1
+# 進捗状況の通知で、変更が無い場合に接続維持のためのコメントを送る間隔(秒)
+PROGRESS_KEEPALIVE_SEC = 30
+JST = timezone(timedelta(hours=9))
+# LC_wrapperのタイムスタンプ e.g. '2024-10-18 19:32:54(JST)'
+JST_TIMESTAMP_PATTERN = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2}) ?\(JST\)')
+
+
+class ScoreResult():
+    REGISTERED = 'registered'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
 
 
 def jst2datetime(dt: str) -> datetime:
     """JSTのタイムスタンプをdatetime型に変換する
 
     LC_wrapperに登録されているタイムスタンプ型をタイムゾーン情報を持つdatetime型に変換する。
+    ログ1件ごとに呼び出されるため、書式が固定のタイムスタンプはstrptimeを使わずに変換する。
 
     :param dt: JSTタイムスタンプ（'%Y-%m-%d %H:%M:%S (JST)'）
     :type dt: string
@@ -48,11 +79,17 @@ def jst2datetime(dt: str) -> datetime:
     :rtype: datetime
 
     >>> jst2datetime("2024-10-18 19:32:54(JST)")
-    datetime.datetime(2024, 10, 18, 19, 32, 54, tzinfo=timezone(datetime.timedelta(seconds=32400)))
+    datetime.datetime(2024, 10, 18, 19, 32, 54, tzinfo=datetime.timezone(datetime.timedelta(seconds=32400)))
+    >>> jst2datetime("2024-10-18 19:32:54 (JST)") == jst2datetime("2024-10-18 19:32:54(JST)")
+    True
     """
-    converted_dt = datetime.strptime(
-        dt.replace('(JST)', ' +0900'), '%Y-%m-%d %H:%M:%S %z')
-    return converted_dt
+    m = JST_TIMESTAMP_PATTERN.fullmatch(dt)
+    if m is None:
+        return datetime.strptime(
+            dt.replace('(JST)', ' +0900'), '%Y-%m-%d %H:%M:%S %z')
+    year, month, day, hour, minute, second = m.groups()
+    return datetime(int(year), int(month), int(day),
+                    int(hour), int(minute), int(second), tzinfo=JST)
 
 
 def get_cell_info(cells: list) -> list:
@@ -170,84 +207,347 @@ def get_cell_info(cells: list) -> list:
     return cell_ids
 
 
-def update_or_create_log_student(db_url: str, students: list):
-    """コースの学生一覧をDBに登録する
-    Delete&Insertを行う。LMSから削除された学生はログからも削除される。
+class NotebookCellCache():
+    """リリース版ノートブックのセル情報をキャッシュする
 
-    :param db_path: DBファイルのパス
-    :type db_path: string
-    :param students: 学生名リスト e.g. ['student01', 'student02',]
-    :type students: list
+    ノートブックのパスごとに、mtime・サイズ・内容のハッシュ値とセル情報を保持する。
+    mtime・サイズが変わっていなければノートブックを読み取らない。
+    変わっていても内容のハッシュ値が同じであればセル情報を作り直さない。
+    また、DBごとにセル情報を登録済みのノートブックのハッシュ値を保持し、
+    ノートブックが変更されていなければセルの登録を省略できるようにする。
+    DBはinit_dbの返す値で区別し、DBファイルが作り直された場合は改めて登録する。
+    複数スレッドから利用できる。
     """
-    if len(students) == 0:
-        return
-    engine = create_engine(db_url)
-    data = [StudentCreate(id=student_id) for student_id in students]
-    with Session(engine) as session:
-        crud.create_students(session=session, students_create=data,
-                             skip_exists=True)
 
+    def __init__(self):
+        self._entries = dict()
+        # ((DBのURL, 世代番号), ノートブックのパス) -> 登録済みのハッシュ値
+        self._registered = dict()
+        self._lock = threading.Lock()
 
-def update_or_create_cell_id(db_url: str, notebook_name: str,
-                             assignment: str, cell_infos: list):
-    """コースの課題に設定されているノートブックから、コードセルのID一覧をDBに登録する
+    def get(self, notebook_path: str) -> tuple[list, str]:
+        """ノートブックのセル情報を返す
 
-    :param db_path: DBファイルのパス
-    :type db_path: string
-    :param notebook_name: ノートブック名
-    :type notebook_name: string
-    :param assignment: 課題名
-    :type assignment: string
-    :param cell_infos: セル情報リスト e.g. [{'cell_id': 'cell01', 'section': '1.1.1'}]
-    :type cell_infos: list
+        :param notebook_path: ノートブックのパス
+        :type notebook_path: string
+        :returns: セル情報リストと、ノートブックの内容のハッシュ値
+        :rtype: tuple
+        """
+        stat = os.stat(notebook_path)
+        with self._lock:
+            entry = self._entries.get(notebook_path)
+        if entry is not None and \
+           entry['mtime_ns'] == stat.st_mtime_ns and \
+           entry['size'] == stat.st_size:
+            return entry['cell_infos'], entry['digest']
+
+        with open(notebook_path, mode='rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if entry is not None and entry['digest'] == digest:
+            cell_infos = entry['cell_infos']
+        else:
+            cell_infos = get_cell_info(json.loads(content)['cells'])
+        with self._lock:
+            self._entries[notebook_path] = dict(
+                mtime_ns=stat.st_mtime_ns, size=stat.st_size,
+                digest=digest, cell_infos=cell_infos)
+        return cell_infos, digest
+
+    def is_registered(self, db_key: tuple, notebook_path: str,
+                      digest: str) -> bool:
+        """ハッシュ値がdigestのノートブックのセル情報がDBに登録済みか"""
+        with self._lock:
+            return self._registered.get((db_key, notebook_path)) == digest
+
+    def set_registered(self, db_key: tuple, notebook_path: str, digest: str):
+        """ノートブックのセル情報をDBに登録したことを記録する
+
+        DBへのコミット後に呼び出すこと。
+        """
+        with self._lock:
+            self._registered[(db_key, notebook_path)] = digest
+
+
+notebook_cell_cache = NotebookCellCache()
+
+
+class LogDBWriter():
+    """ログ収集結果をまとめてDBに登録する
+
+    学生・セル・ログ・取り込み状況の登録内容を溜め込み、複数行のupsertとして
+    まとめて発行する。ログはflush_size件溜まるごとに発行し、
+    コミットはcommit()の呼び出し時に1度だけ行う。
+    学生・セルごとの最新のログ(latest_logテーブル)もログの登録に併せて更新する。
+    ログファイルが作り直された学生・セルの最新のログは、更新前に削除する(reset_latest_logs)。
     """
 
-    if len(cell_infos) == 0:
-        return
-    engine = create_engine(db_url)
-    data = [CellCreate(id=cell_info['cell_id'],
-                       assignment=assignment,
-                       section=cell_info['section'],
-                       notebook_name=notebook_name,
-                       jupyter_cell_id=cell_info['jupyter_cell_id'],
-                       nbgrader_cell_id=cell_info['nbgrader_cell_id']) for cell_info in cell_infos]
-    with Session(engine) as session:
-        # TODO skip_existsではなく、skip="update"/"ignore"/"error" nbgrader_cell_idなど変更OKなものがあるため。
-        # 現状、nbgraderでは提出がある課題は再generate出来ないので、cell定義が変更されることは無い。
-        crud.create_cells(session=session, cells_create=data, skip_exists=True)
-        session.commit()
-
-
-def update_or_create_log(db_url: str,  notebook_name: str,
-                         assignment: str, user_id: str,
-                         cell_id: str, logs: list[dict], dt_from: datetime,
-                         dt_to: datetime):
-    """学生の実行履歴情報をDBに登録する
+    def __init__(self, session: Session, flush_size: int = 5000):
+        self.session = session
+        self.flush_size = flush_size
+        self.students = list()
+        self.cells = list()
+        self.logs = list()
+        self.latest_logs = dict()
+        self.reset_keys = list()
+        self.scan_states = list()
+
+    def add_students(self, students: list):
+        """コースの学生一覧を登録対象に追加する
+
+        :param students: 学生名リスト e.g. ['student01', 'student02',]
+        :type students: list
+        """
+        self.students.extend(
+            [StudentCreate(id=student_id) for student_id in students])
+
+    def add_cells(self, notebook_name: str, assignment: str,
+                  cell_infos: list):
+        """課題に設定されているノートブックのコードセルを登録対象に追加する
+
+        :param notebook_name: ノートブック名
+        :type notebook_name: string
+        :param assignment: 課題名
+        :type assignment: string
+        :param cell_infos: セル情報リスト e.g. [{'cell_id': 'cell01', 'section': '1.1.1'}]
+        :type cell_infos: list
+        """
+        self.cells.extend(
+            [CellCreate(id=cell_info['cell_id'],
+                        assignment=assignment,
+                        section=cell_info['section'],
+                        notebook_name=notebook_name,
+                        jupyter_cell_id=cell_info['jupyter_cell_id'],
+                        nbgrader_cell_id=cell_info['nbgrader_cell_id'])
+             for cell_info in cell_infos])
+
+    def reset_latest_logs(self, keys: list[tuple]):
+        """最新のログを削除する学生・セルを追加する
+
+        削除は、以降に追加したログによる最新のログの更新より前に行う。
+
+        :param keys: (課題名, 学生名, セルID)のリスト
+        :type keys: list
+        """
+        self.reset_keys.extend(keys)
+
+    def add_logs(self, logs: list[LogCreate]):
+        self.logs.extend(logs)
+        for log in logs:
+            key = (log.assignment, log.student_id, log.cell_id)
+            latest = self.latest_logs.get(key)
+            if latest is None or latest.log_sequence < log.log_sequence:
+                self.latest_logs[key] = LatestLogCreate(
+                    assignment=log.assignment,
+                    student_id=log.student_id,
+                    cell_id=log.cell_id,
+                    log_sequence=log.log_sequence,
+                    log_execute_reply_status=log.log_execute_reply_status,
+                    log_start=log.log_start,
+                    log_end=log.log_end)
+        if len(self.logs) >= self.flush_size:
+            self.flush()
+
+    def add_scan_state(self, scan_state: ScanStateCreate):
+        self.scan_states.append(scan_state)
+
+    def flush(self):
+        """溜め込んだ登録内容をDBに発行する
+        """
+        if len(self.students) > 0:
+            crud.create_students(session=self.session,
+                                 students_create=self.students,
+                                 skip_exists=True)
+            self.students = list()
+        if len(self.cells) > 0:
+            # TODO skip_existsではなく、skip="update"/"ignore"/"error" nbgrader_cell_idなど変更OKなものがあるため。
+            # 現状、nbgraderでは提出がある課題は再generate出来ないので、cell定義が変更されることは無い。
+            crud.create_cells(session=self.session, cells_create=self.cells,
+                              skip_exists=True)
+            self.cells = list()
+        if len(self.logs) > 0:
+            crud.create_logs(session=self.session, log_creates=self.logs,
+                             skip_exists=True)
+            self.logs = list()
+        if len(self.reset_keys) > 0:
+            crud.delete_latest_logs(session=self.session, keys=self.reset_keys)
+            self.reset_keys = list()
+        if len(self.latest_logs) > 0:
+            crud.update_latest_logs(
+                session=self.session,
+                latest_logs_create=list(self.latest_logs.values()))
+            self.latest_logs = dict()
+        if len(self.scan_states) > 0:
+            crud.update_scan_states(session=self.session,
+                                    scan_states_create=self.scan_states)
+            self.scan_states = list()
+
+    def commit(self):
+        self.flush()
+        self.session.commit()
+
+
+class LogFileReader():
+    """LC_wrapperのログファイル(ログのJSON配列)を1件ずつ読み取る
+
+    ファイル全体を読み込まずに、先頭から順に(ログ, ログの直後のバイト位置)を返す。
+    offsetに前回読み取ったログの直後のバイト位置を指定すると、そこから読み取りを再開する。
+    LC_wrapperはログを配列の末尾に追記するため、登録済みのログの位置は変わらない。
+
+    :param f: バイナリモードで開いたログファイル
+    :type f: io.BufferedReader
+    :param offset: 読み取りを再開するバイト位置。Noneの場合はファイルの先頭から読み取る
+    :type offset: int
+    :param chunk_size: 1回に読み取るバイト数
+    :type chunk_size: int
+    :raises ValueError: offsetがログの直後の位置でない場合(ログファイルが作り直されている)
+    """
+
+    _decoder = json.JSONDecoder()
+    _whitespace = ' \t\n\r'
+
+    def __init__(self, f, offset: int | None = None,
+                 chunk_size: int = LOG_READ_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.resume = offset is not None
+        # self._buf[self._pos]のファイル上のバイト位置
+        self.offset = offset if offset is not None else 0
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._closed = False
+
+        if self.resume:
+            # ログ(JSONオブジェクト)の直後であり、','または']'が続くこと
+            if offset < 1:
+                raise ValueError(f'invalid offset: {offset}')
+            f.seek(offset - 1)
+            if f.read(1) != b'}':
+                raise ValueError(f'invalid offset: {offset}')
+            self._closed = self._expect(',]') == ']'
+        else:
+            f.seek(0)
+            self._expect('[')
+            if self._peek() == ']':
+                self._advance(self._pos + 1)
+                self._closed = True
+
+    def _read(self, size: int) -> bool:
+        """バッファに読み足す。既にファイル末尾に達している場合はFalseを返す"""
+        if self._eof:
+            return False
+        data = self.f.read(size)
+        self._eof = not data
+        self._buf = self._buf[self._pos:] + self._text_decoder.decode(
+            data, final=self._eof)
+        self._pos = 0
+        return True
+
+    def _advance(self, end: int):
+        self.offset += len(self._buf[self._pos:end].encode('utf-8'))
+        self._pos = end
+
+    def _peek(self) -> str:
+        """空白を読み飛ばし、次の文字を返す。ファイル末尾の場合は空文字列を返す"""
+        while True:
+            buf = self._buf
+            end = self._pos
+            while end < len(buf) and buf[end] in self._whitespace:
+                end += 1
+            # 空白はASCII文字のみ
+            self.offset += end - self._pos
+            self._pos = end
+            if end < len(buf):
+                return buf[end]
+            if not self._read(self.chunk_size):
+                return ''
+
+    def _expect(self, chars: str) -> str:
+        c = self._peek()
+        if c == '' or c not in chars:
+            raise ValueError(
+                f'expected {chars!r} but got {c!r} at offset {self.offset}')
+        self._advance(self._pos + 1)
+        return c
+
+    def _decode_log(self) -> dict:
+        if self._peek() != '{':
+            raise ValueError(f'expected a log object at offset {self.offset}')
+        while True:
+            try:
+                log, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # ログがバッファの末尾で途切れている
+                # 大きなログで再解析を繰り返さないよう、読み足す量を倍々に増やす
+                if not self._read(max(self.chunk_size, len(self._buf))):
+                    raise
+                continue
+            self._advance(end)
+            return log
+
+    def __iter__(self):
+        if self._closed:
+            return
+        while True:
+            log = self._decode_log()
+            yield log, self.offset
+            if self._expect(',]') == ']':
+                self._closed = True
+                return
+
+
+def get_log_creates(notebook_name: str, assignment: str, user_id: str,
+                    cell_id: str, logs: Iterable[tuple[dict, int]],
+                    dt_from: datetime, dt_to: datetime,
+                    start_sequence: int = 0,
+                    start_offset: int | None = None
+                    ) -> tuple[list[LogCreate], int, int | None, bool]:
+    """学生の実行履歴情報からDBの登録内容を作成する
     ログの実行完了時刻が指定日時内でない場合は登録しない。
+    dt_fromより前のログは登録済みのログと同様に扱い、次回以降の収集では読み取らない。
+    ログは実行完了順に並んでいるため、dt_toより後のログが現れた時点で読み取りを終える。
 
-    :param db_url: DBファイルのパス
-    :type db_url: string
     :param notebook_name: ノートブック名
     :type notebook_name: string
     :param assignment: 課題名
     :type assignment: string
-    :param cell_infos: セル情報リスト e.g. [{'cell_id': 'cell01', 'section': '1.1.1'}]
-    :type cell_infos: list
+    :param user_id: 学生名
+    :type user_id: string
+    :param cell_id: セルID
+    :type cell_id: string
+    :param logs: LC_wrapperのログと、ログの直後のバイト位置 e.g. LogFileReader
+    :type logs: Iterable
     :param dt_from: 対象データの始点日時
     :type dt_from: datetime
     :param dt_to: 対象データの終点日時
     :type dt_to: datetime
+    :param start_sequence: logsの先頭のログのインデックス
+    :type start_sequence: int
+    :param start_offset: start_sequenceの直前のログの直後のバイト位置
+    :type start_offset: int
+    :returns: 登録内容、先頭から連続して登録済みとなるログの最終インデックスとその直後のバイト位置、
+              ファイル末尾まで全てのログを登録済みとなったか
+    :rtype: tuple
     """
 
-    if len(logs) == 0:
-        return
-
+    ingested_sequence = start_sequence - 1
+    ingested_offset = start_offset
+    last_sequence = start_sequence - 1
     values = list()
 
-    for i, log in enumerate(logs):
-
-        # TODO: そもそも取得しないよう修正する
-        if jst2datetime(log['end']) > dt_to or dt_from > jst2datetime(log['end']):
+    for i, (log, end_offset) in enumerate(logs, start_sequence):
+        log_end = jst2datetime(log['end'])
+        if log_end > dt_to:
+            # 以降のログも対象外のため、ファイルの残りは読み取らない
+            return values, ingested_sequence, ingested_offset, False
+
+        last_sequence = i
+        if ingested_sequence == i - 1:
+            ingested_sequence = i
+            ingested_offset = end_offset
+        if dt_from > log_end:
             continue
 
         values.append(LogCreate(
@@ -260,7 +560,7 @@ def update_or_create_log(db_url: str,  notebook_name: str,
             log_code=log['code'],
             log_path=log['path'],
             log_start=jst2datetime(log['start']),
-            log_end=jst2datetime(log['end']),
+            log_end=log_end,
             log_size=log['size'],
             log_server_signature=log['server_signature'],
             log_uid=log['uid'],
@@ -269,19 +569,130 @@ def update_or_create_log(db_url: str,  notebook_name: str,
             log_lc_notebook_meme=log['lc_notebook_meme'],
             log_execute_reply_status=log['execute_reply_status'],
         ))
-    if len(values) == 0:
-        return
-    engine = create_engine(db_url)
-    with Session(engine) as session:
-        crud.create_logs(session=session, log_creates=values, skip_exists=True)
-        session.commit()
+    return (values, ingested_sequence, ingested_offset,
+            ingested_sequence == last_sequence)
+
+
+def scan_student_logs(homedir: str, course: str, student: str,
+                      assign_info: dict, scan_states: dict,
+                      dt_from: datetime, dt_to: datetime) -> dict:
+    """学生1人分のログファイルを読み取り、DBの登録内容を作成する
+    前回収集時から変更の無いログファイルは読み取らない。
+    変更のあるログファイルは、前回までに登録済みのログの直後から読み取る。
+    複数の学生について並列に呼び出されるため、DBにはアクセスしない。
+
+    :param homedir: ホームディレクトリ
+    :type homedir: string
+    :param course: コース名
+    :type course: string
+    :param student: 学生名
+    :type student: string
+    :param assign_info: 課題ごとのノートブックとセル情報
+    :type assign_info: dict
+    :param scan_states: ログファイルの取り込み状況
+    :type scan_states: dict
+    :param dt_from: 対象データの始点日時
+    :type dt_from: datetime
+    :param dt_to: 対象データの終点日時
+    :type dt_to: datetime
+    :returns: 登録内容と件数 e.g. {'logs': [], 'scan_states': [], 'recreated': [], 'files_scanned': 0, 'files_read': 0}
+              recreatedは、ログファイルが作り直された(課題名, 学生名, セルID)のリスト
+    :rtype: dict
+    """
+
+    result = dict(logs=list(), scan_states=list(), recreated=list(),
+                  files_scanned=0, files_read=0)
+    student_local_course_dir = os.path.join(homedir, student, course)
+    if not os.path.isdir(student_local_course_dir):
+        return result
+
+    for assign_name, notebooks in assign_info.items():
+        student_local_assign_dir = os.path.join(
+            student_local_course_dir, assign_name)
+
+        if not os.path.isdir(student_local_assign_dir):
+            # 課題未フェッチ
+            continue
+        student_local_log_dir = os.path.join(
+            student_local_assign_dir, '.log')
+        if not os.path.isdir(student_local_log_dir):
+            # ログ出力無し
+            continue
+        for notebook in notebooks['notebooks']:
+            notebook_name = list(notebook.keys())[0]
+            student_local_notebook = os.path.join(
+                student_local_assign_dir,
+                notebook_name)
+            if not os.path.isfile(student_local_notebook):
+                # Notebook不存在
+                continue
+            for cell_info in notebook[notebook_name]['cell_infos']:
+                cell_id = cell_info['cell_id']
+                log_json = os.path.join(student_local_log_dir, cell_id,
+                                        cell_id + '.json')
+                try:
+                    stat = os.stat(log_json)
+                except FileNotFoundError:
+                    continue
+                result['files_scanned'] += 1
+
+                # 前回収集時から変更が無ければ読み取らない
+                state_key = os.path.relpath(log_json, homedir)
+                state = scan_states.get(state_key)
+                if state is not None and \
+                   state.mtime_ns == stat.st_mtime_ns and \
+                   state.size == stat.st_size:
+                    continue
+
+                result['files_read'] += 1
+                start_sequence = 0
+                start_offset = None
+                if state is not None and state.log_sequence >= 0 and \
+                   state.log_offset is not None and \
+                   state.log_offset <= stat.st_size:
+                    start_sequence = state.log_sequence + 1
+                    start_offset = state.log_offset
+
+                with open(log_json, 'rb') as f:
+                    logs = None
+                    if start_offset is not None:
+                        try:
+                            logs = LogFileReader(f, start_offset)
+                        except ValueError:
+                            # ログファイルが作り直されている
+                            start_sequence = 0
+                            start_offset = None
+                    if logs is None:
+                        logs = LogFileReader(f)
+                    if start_sequence == 0 and state is not None and \
+                       state.log_sequence >= 0:
+                        # 登録済みのログがあるのに先頭から読み取る場合は、作り直されたとみなす
+                        result['recreated'].append(
+                            (assign_name, student, cell_id))
+                    log_creates, ingested_sequence, ingested_offset, completed = \
+                        get_log_creates(
+                            notebook_name, assign_name, student, cell_id,
+                            logs, dt_from, dt_to,
+                            start_sequence=start_sequence,
+                            start_offset=start_offset)
+                result['logs'].extend(log_creates)
+                result['scan_states'].append(ScanStateCreate(
+                    path=state_key,
+                    mtime_ns=stat.st_mtime_ns if completed else None,
+                    size=stat.st_size if completed else None,
+                    log_sequence=ingested_sequence,
+                    log_offset=ingested_offset,
+                ))
+    return result
 
 
 def log2db(course: str, user_name: str,
            homedir: str = '/jupyter',
            dt_from: datetime = DEFAULT_DT_FROM,
            dt_to: datetime | None = None,
-           assignment: str | list = None) -> str:
+           assignment: str | list = None,
+           progress: dict | None = None,
+           workers: int = LOG_SCAN_WORKERS) -> str:
     """ログファイルを読み取り、DBに登録する
 
     :param course: コース名
@@ -296,23 +707,18 @@ def log2db(course: str, user_name: str,
     :type dt_to: datetime defaults to datetime.now(timezone.utc)
     :param assignment: 課題名 Noneの場合、コース内の全ての課題を対象とする
     :type assignment: string
+    :param progress: 進捗件数の書き込み先
+    :type progress: dict
+    :param workers: ログファイルを並列に読み取るスレッド数
+    :type workers: int
     :returns: 作成したDBファイルのパス
     :rtype: string
     """
 
-    def _load_log_json(log_dir: str, cell_id: str) -> dict:
-        """ログ情報を読み取る
-        """
-        log_json = os.path.join(log_dir, cell_id, cell_id+'.json')
-        if not os.path.isfile(log_json):
-            return {}
-
-        with open(log_json, 'r', encoding='utf8') as f:
-            logs = json.load(f)
-
-        return logs
-
     dt_to = dt_to if dt_to is not None else datetime.now(timezone.utc)
+    progress = progress if progress is not None else dict()
+    progress.update(students_total=0, students_done=0,
+                    files_scanned=0, files_read=0, logs=0)
     original_file_dir = 'release'
     teacher_home = os.path.join(homedir, user_name)
     course_path = os.path.join(teacher_home, 'nbgrader', course)
@@ -320,7 +726,7 @@ def log2db(course: str, user_name: str,
     if not os.path.isdir(course_path):
         raise FileNotFoundError(os.path.join('nbgrader', course))
     log_db_url = os.getenv('LOG_DB_URL', f'sqlite:////{course_path}/exec_history.db')
-    init_db(log_db_url)
+    db_key = init_db(log_db_url)
     nbg_db_path = db_path(user_name, course, homedir)
     students = get_course_students(nbg_db_path, course)
     if assignment is not None:
@@ -334,70 +740,61 @@ def log2db(course: str, user_name: str,
     else:
         # 課題の指定が無い場合、nbgraderに登録されているものが全て対象
         assignments = get_course_assignments(user_name, course, homedir)
-    update_or_create_log_student(log_db_url, students)
-
-    # cell_idリストの作成
-    assign_info = dict()
-    for assignment_name in assignments:
-        if assignment_name not in assign_info:
-            assign_info[assignment_name] = dict(notebooks=list())
-
-        teacher_notebooks = glob.glob(
-                                os.path.join(course_path,
-                                             original_file_dir,
-                                             assignment_name, '*.ipynb'))
-
-        for notebook_path in teacher_notebooks:
-            if not os.path.isfile(notebook_path):
-                continue
-            with open(notebook_path, mode='r', encoding='utf8') as f:
-                cell_infos = get_cell_info(json.load(f)['cells'])
-            nb_name = os.path.basename(notebook_path)
-            update_or_create_cell_id(log_db_url,
-                                     nb_name,
-                                     assignment_name,
-                                     cell_infos)
-            assign_info[assignment_name]['notebooks'].append(
-                {nb_name: dict(cell_infos=cell_infos)})
-
-    # 学生のログを収集
-    for student in students:
-        student_local_course_dir = os.path.join(homedir, student,
-                                                course)
-        if not os.path.isdir(student_local_course_dir):
-            continue
 
-        for assign_name, notebooks in assign_info.items():
-            student_local_assign_dir = os.path.join(
-                student_local_course_dir, assign_name)
-
-            if not os.path.isdir(student_local_assign_dir):
-                # 課題未フェッチ
-                continue
-            student_local_log_dir = os.path.join(
-                student_local_assign_dir, '.log')
-            if not os.path.isdir(student_local_log_dir):
-                # ログ出力無し
-                continue
-            for notebook in notebooks['notebooks']:
-                notebook_name = list(notebook.keys())[0]
-                student_local_notebook = os.path.join(
-                    student_local_assign_dir,
-                    notebook_name)
-                if not os.path.isfile(student_local_notebook):
-                    # Notebook不存在
+    with Session(get_engine(log_db_url)) as session:
+        writer = LogDBWriter(session)
+        writer.add_students(students)
+        scan_states = crud.get_scan_states(session=session)
+
+        # cell_idリストの作成
+        # リリース版のノートブックはほとんど変更されないため、セル情報はキャッシュを使う
+        assign_info = dict()
+        registered_notebooks = list()
+        for assignment_name in assignments:
+            if assignment_name not in assign_info:
+                assign_info[assignment_name] = dict(notebooks=list())
+
+            teacher_notebooks = glob.glob(
+                                    os.path.join(course_path,
+                                                 original_file_dir,
+                                                 assignment_name, '*.ipynb'))
+
+            for notebook_path in teacher_notebooks:
+                if not os.path.isfile(notebook_path):
                     continue
-                for cell_info in notebook[notebook_name]['cell_infos']:
-                    logs = _load_log_json(student_local_log_dir,
-                                          cell_info['cell_id'])
-
-                    if len(logs) > 0:
-                        update_or_create_log(log_db_url, notebook_name,
-                                             assign_name,
-                                             student, cell_info['cell_id'],
-                                             logs,
-                                             dt_from, dt_to)
-
+                cell_infos, digest = notebook_cell_cache.get(notebook_path)
+                nb_name = os.path.basename(notebook_path)
+                if not notebook_cell_cache.is_registered(
+                        db_key, notebook_path, digest):
+                    writer.add_cells(nb_name, assignment_name, cell_infos)
+                    registered_notebooks.append((notebook_path, digest))
+                assign_info[assignment_name]['notebooks'].append(
+                    {nb_name: dict(cell_infos=cell_infos)})
+
+        # 学生のログを収集
+        # ファイルの読み取りは学生ごとに並列に行い、DBへの書き込みはこのスレッドのみで行う
+        progress['students_total'] = len(students)
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix='log_scan') as executor:
+            results = executor.map(
+                lambda student: scan_student_logs(homedir, course, student,
+                                                  assign_info, scan_states,
+                                                  dt_from, dt_to),
+                students)
+            for result in results:
+                writer.reset_latest_logs(result['recreated'])
+                writer.add_logs(result['logs'])
+                for scan_state in result['scan_states']:
+                    writer.add_scan_state(scan_state)
+                progress['students_done'] += 1
+                progress['files_scanned'] += result['files_scanned']
+                progress['files_read'] += result['files_read']
+                progress['logs'] += len(result['logs'])
+
+        writer.commit()
+
+    for notebook_path, digest in registered_notebooks:
+        notebook_cell_cache.set_registered(db_key, notebook_path, digest)
     return log_db_url
 
 
@@ -500,6 +897,17 @@ class TeacherToolsApiHandler(HubAuthenticated, web.RequestHandler):
             _output = output
         self.write(json.dumps(_output, indent=1, sort_keys=True))
 
+    def directory_not_found(self, e: FileNotFoundError) -> web.HTTPError:
+        """ログ収集の対象のディレクトリが存在しない場合に返すエラーを作成する
+
+        :param e: log2dbの送出したFileNotFoundError。値は教師のホームディレクトリからの相対パス
+        :type e: FileNotFoundError
+        :returns: 400エラー。reasonにディレクトリを含める
+        :rtype: tornado.web.HTTPError
+        """
+        message = f"directory not found: {os.path.join('~', str(e))}"
+        return web.HTTPError(HTTPStatus.BAD_REQUEST, message, reason=message)
+
     def write_error(self, status_code, **kwargs):
         self.set_header("Content-Type", "application/json")
         if "exc_info" in kwargs:
@@ -518,10 +926,16 @@ class TeacherToolsApiHandler(HubAuthenticated, web.RequestHandler):
 
 
 class TeacherToolsLogDBHandler(TeacherToolsApiHandler):
-    """Update log db"""
+    """Update log db
+
+    ログ収集はジョブとしてワーカースレッドで実行する。
+    リクエストパラメータのwaitがfalseの場合、完了を待たずにジョブIDを返す。
+    """
 
     def initialize(self):
         super().initialize()
+        self.jobs = self.settings["log_collect_jobs"]
+        self.log_scan_workers = self.settings["log_scan_workers"]
 
     @web.authenticated
     async def post(self):
@@ -539,6 +953,7 @@ class TeacherToolsLogDBHandler(TeacherToolsApiHandler):
         dt_from = self.json_data.get('from')
         dt_to = self.json_data.get('to')
         assignment = self.json_data.get('assignment')
+        wait = self.json_data.get('wait', True)
         opt = {}
         if dt_from is not None:
             opt['dt_from'] = datetime.fromisoformat(dt_from)
@@ -546,116 +961,360 @@ class TeacherToolsLogDBHandler(TeacherToolsApiHandler):
             opt['dt_to'] = datetime.fromisoformat(dt_to)
         if assignment is not None:
             opt['assignment'] = assignment
-        try:
-            db_path = log2db(course, user["name"], self.homedir, **opt)
-        except FileNotFoundError as e:
-            raise web.HTTPError(
-                HTTPStatus.BAD_REQUEST,
-                f"directory not found: {os.path.join('~', str(e))}"
-            )
+
+        job = self.jobs.submit((user["name"], course),
+                               dict(course=course,
+                                    user_name=user["name"],
+                                    homedir=self.homedir,
+                                    workers=self.log_scan_workers,
+                                    **opt),
+                               log2db)
 
         res = dict()
-        res['db_path'] = db_path
+        res['job_id'] = job.id
         res['dt_from'] = opt['dt_from'].isoformat() if 'dt_from' in opt else ""
         res['dt_to'] = opt['dt_to'].isoformat() if 'dt_to' in opt else ""
         res['assignment'] = opt.get('assignment')
+        if not wait:
+            res['status'] = job.status
+            self.json_output(status_code=HTTPStatus.ACCEPTED, output=res)
+            return
+
+        try:
+            db_path = await job.future
+        except FileNotFoundError as e:
+            raise self.directory_not_found(e)
+
+        res['status'] = job.status
+        res['db_path'] = db_path
         self.json_output(output=res)
 
 
+class TeacherToolsLogJobHandler(TeacherToolsApiHandler):
+    """Get status of log collection job"""
+
+    def initialize(self):
+        super().initialize()
+        self.jobs = self.settings["log_collect_jobs"]
+
+    @web.authenticated
+    def get(self, job_id):
+        user = self.get_current_user()
+        job = self.jobs.get(job_id)
+        if job is None or job.key[0] != user["name"]:
+            raise web.HTTPError(
+                HTTPStatus.NOT_FOUND, f"Not found job: {job_id}"
+            )
+        self.json_output(output=job.to_dict())
+
+
+class TeacherToolsProgressHandler(TeacherToolsApiHandler):
+    """Get progress of an assignment
+
+    学生×セルごとの最新の実行結果を返す。進捗状況はサーバ側で一定間隔ごとに
+    作り直し、全ての閲覧者で共有する。内容に変更が無い場合、
+    If-None-Matchヘッダを指定したリクエストにはボディ無しで304を返す。
+    """
+
+    def initialize(self):
+        super().initialize()
+        self.jobs = self.settings["log_collect_jobs"]
+        self.log_scan_workers = self.settings["log_scan_workers"]
+        self.snapshots = self.settings["progress_snapshots"]
+
+    @web.authenticated
+    async def get(self, assignment):
+        user = self.get_current_user()
+        course = self.get_argument('course', None)
+        if course is None:
+            raise web.HTTPError(
+                HTTPStatus.BAD_REQUEST, reason="Missing required paramater: ['course']"
+            )
+
+        try:
+            snapshot = await self.snapshots.get(
+                (user["name"], course, assignment),
+                dict(course=course,
+                     user_name=user["name"],
+                     homedir=self.homedir,
+                     workers=self.log_scan_workers,
+                     assignment=assignment),
+                log2db)
+        except FileNotFoundError as e:
+            raise self.directory_not_found(e)
+
+        self.set_header("Etag", snapshot.etag)
+        # 保存した内容を使う場合も、必ず再検証させる
+        self.set_header("Cache-Control", "no-cache")
+        if self.check_etag_header():
+            self.set_status(HTTPStatus.NOT_MODIFIED)
+            return
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(snapshot.body)
+
+
+class TeacherToolsProgressEventHandler(TeacherToolsApiHandler):
+    """Push progress of an assignment as Server-Sent Events
+
+    接続時に進捗状況全体をsnapshotイベントとして送り、以降は実行結果が変わった
+    セルのみをupdateイベントとして送る。イベントIDは進捗状況のETag。
+    学生・セルの構成が変わった場合や、途中の変更を送り損ねた場合はsnapshotを送り直す。
+    再接続時にLast-Event-IDが最新のETagと一致する場合、snapshotは送らない。
+    切断された場合は、次のkeepaliveを待たずに変更の待ち受けを終了する。
+    """
+
+    def initialize(self):
+        super().initialize()
+        self.log_scan_workers = self.settings["log_scan_workers"]
+        self.snapshots = self.settings["progress_snapshots"]
+        self.send_task = None
+
+    def on_connection_close(self):
+        if self.send_task is not None:
+            self.send_task.cancel()
+
+    def send_event(self, event: str, event_id: str, data: bytes | str):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.write(f"id: {event_id}\nevent: {event}\n".encode('utf-8'))
+        self.write(b"data: " + data + b"\n\n")
+
+    @web.authenticated
+    async def get(self, assignment):
+        user = self.get_current_user()
+        course = self.get_argument('course', None)
+        if course is None:
+            raise web.HTTPError(
+                HTTPStatus.BAD_REQUEST, reason="Missing required paramater: ['course']"
+            )
+
+        self.set_header("Content-Type", "text/event-stream; charset=UTF-8")
+        self.set_header("Cache-Control", "no-cache")
+        # リバースプロキシでバッファリングさせない
+        self.set_header("X-Accel-Buffering", "no")
+
+        watcher = self.snapshots.watch(
+            (user["name"], course, assignment),
+            dict(course=course,
+                 user_name=user["name"],
+                 homedir=self.homedir,
+                 workers=self.log_scan_workers,
+                 assignment=assignment),
+            log2db,
+            timeout=PROGRESS_KEEPALIVE_SEC)
+        self.send_task = asyncio.ensure_future(self.send_events(
+            watcher, self.request.headers.get("Last-Event-ID")))
+        try:
+            await self.send_task
+        except asyncio.CancelledError:
+            # 切断された(on_connection_close)
+            pass
+
+    async def send_events(self, watcher, last_etag: str | None):
+        """スナップショットが変わるたびにイベントを送る
+
+        :param watcher: ProgressSnapshotManager.watch()
+        :param last_etag: 閲覧者が最後に受け取ったイベントID
+        :type last_etag: str
+        """
+        try:
+            async for snapshot in watcher:
+                if snapshot is None:
+                    self.write(b": keepalive\n\n")
+                elif snapshot.etag == last_etag:
+                    continue
+                elif snapshot.previous_etag == last_etag and \
+                        snapshot.changes is not None:
+                    self.send_event('update', snapshot.etag, json.dumps(
+                        dict(changes=snapshot.changes,
+                             updated_at=snapshot.progress['updated_at']),
+                        ensure_ascii=False, separators=(',', ':')))
+                else:
+                    self.send_event('snapshot', snapshot.etag, snapshot.body)
+                if snapshot is not None:
+                    last_etag = snapshot.etag
+                await self.flush()
+        except FileNotFoundError as e:
+            # 最初のスナップショットの作成に失敗した場合は、まだ何も送っていない
+            raise self.directory_not_found(e)
+        except StreamClosedError:
+            pass
+        finally:
+            await watcher.aclose()
+
+
+class TeacherToolsMetricsHandler(TeacherToolsApiHandler):
+    """Get prometheus metrics of this service
+
+    LMSへのリクエスト(成績の送信など)はteachertoolsのプロセスで行うため、
+    そのmetricsはJupyterHubの/metricsではなく、ここで公開する。
+    """
+
+    @web.authenticated
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.write(generate_latest())
+
+
 class TeacherToolsUpdateHandler(TeacherToolsOutputHandler):
     """POST grades to LMS with AGS"""
 
     hub_users = []
     allow_admin = True
 
-    def initialize(self, lms_token_endpoint, lms_client_id):
+    def initialize(self, lms_token_endpoint, lms_client_id, lms_client,
+                   ags_concurrency=8, ags_max_retries=3):
         super().initialize()
         self.lms_token_endpoint = lms_token_endpoint
         self.lms_client_id = lms_client_id
+        self.lms_client = lms_client
+        self.ags_concurrency = ags_concurrency
+        self.ags_max_retries = ags_max_retries
+
+    def get_uids(self, usernames: list) -> dict:
+        """ユーザ名に対応するuidNumberを返す
+
+        キャッシュに無いユーザのみ、1回のLDAP接続でまとめて検索する。
+        LDAPに登録されていないユーザはNoneとなる。
+        """
+        uids = {username: uid_cache.get(username) for username in usernames}
+        missing = [username for username, uid in uids.items() if uid is None]
+        if len(missing) == 0:
+            return uids
 
-    def get_uid(self, username):
         ldap_manager_dn = f'cn={os.getenv("LDAP_ADMIN", "Manager")},'\
                         'dc=jupyterhub,dc=server,dc=sample,dc=jp'
         ldapconn = ldapClient(os.environ['LDAP_SERVER'],
                               ldap_manager_dn,
                               os.environ['LDAP_PASSWORD'])
-        search_result = ldapconn.search_user(username, ['uidNumber'])
-        return int(search_result[0].uidNumber.value) if search_result is not None else None
-
-    def _request_lms(self, url, headers, method="GET", params=None, data=None, timeout=10):
-        global lms_token
-        if lms_token is None:
-            lms_token = get_lms_lti_token(
-                                require_scopes,
-                                os.environ['JUPYTERHUB_BASE_URL'],
-                                private_key,
-                                self.lms_token_endpoint,
-                                self.lms_client_id)
+        search_result = ldapconn.search_users(missing, ['uidNumber'])
+        for username in missing:
+            entry = search_result.get(username.lower())
+            if entry is None:
+                continue
+            uids[username] = int(entry.uidNumber.value)
+            uid_cache.set(username, uids[username])
+        return uids
+
+    def _get_lms_token(self, invalid_token=None):
+        key = (self.lms_token_endpoint, self.lms_client_id)
+        if key not in lti_token_managers:
+            lti_token_managers[key] = LtiTokenManager(
+                os.environ['JUPYTERHUB_BASE_URL'],
+                private_key,
+                self.lms_token_endpoint,
+                self.lms_client_id)
+        return lti_token_managers[key].get_token(require_scopes,
+                                                 invalid_token=invalid_token)
+
+    async def _fetch_lms(self, url, headers, method="GET", params=None,
+                         data=None, timeout=10, retry=False):
+        """LMSにリクエストを送信する
+        接続は共有の接続プールから再利用する。GETなどの冪等なメソッドの再送はlms_clientが行う。
+        retryがTrueの場合(成績の送信など、重複して送信しても結果が変わらないPOST)、
+        429/5xxの応答や通信エラーの場合、間隔を空けて最大ags_max_retries回再送する。
+        """
+        request = functools.partial(self.lms_client.request, method, url,
+                                    headers=headers, params=params,
+                                    data=data, timeout=timeout)
+        if not retry:
+            return await IOLoop.current().run_in_executor(None, request)
+
+        for attempt in range(self.ags_max_retries + 1):
+            delay = AGS_RETRY_BACKOFF_SEC * 2 ** attempt
+            try:
+                response = await IOLoop.current().run_in_executor(None, request)
+            except requests.RequestException as e:
+                if attempt >= self.ags_max_retries:
+                    raise
+                self.log.warning(f"LMS request failed and will be retried: {url} {e}")
+            else:
+                if response.status_code not in LMS_RETRY_STATUS:
+                    return response
+                if attempt >= self.ags_max_retries:
+                    return response
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                self.log.warning(f"LMS returned {response.status_code} and will be retried: {url}")
+            await asyncio.sleep(delay)
+
+    async def _request_lms(self, url, headers, method="GET", params=None,
+                           data=None, timeout=10, retry=False):
+        lms_token = await IOLoop.current().run_in_executor(
+            None, self._get_lms_token)
         _headers = headers.copy()
         _headers['Authorization'] = f'Bearer {lms_token}'
 
-        response = requests.request(
-            method,
-            url,
-            params=params,
-            data=data,
-            headers=_headers,
-            timeout=timeout
-        )
+        response = await self._fetch_lms(url, _headers, method=method,
+                                         params=params, data=data,
+                                         timeout=timeout, retry=retry)
         if HTTPStatus.UNAUTHORIZED == response.status_code:
             # service用tokenが有効期限切れになっている場合再発行
-            lms_token = get_lms_lti_token(require_scopes,
-                                            os.environ['JUPYTERHUB_BASE_URL'],
-                                            private_key,
-                                            self.lms_token_endpoint,
-                                            self.lms_client_id)
+            lms_token = await IOLoop.current().run_in_executor(
+                None, self._get_lms_token, lms_token)
             self.log.warning("LMS access token expired and recreated.")
             # 再度リクエスト
             _headers['Authorization'] = f'Bearer {lms_token}'
-            response = requests.request(
-                method,
-                url,
-                params=params,
-                data=data,
-                headers=_headers,
-                timeout=timeout
-            )
+            response = await self._fetch_lms(url, _headers, method=method,
+                                             params=params, data=data,
+                                             timeout=timeout, retry=retry)
         if HTTPStatus.UNAUTHORIZED == response.status_code:
             # service用tokenの再発行に失敗
             self.log.error(f"LMS access token expired and refresh failed. msg: {response.text}")
             raise TeacherToolsException(response.text)
         return response
 
-    def get_lineitem_id_from_assignment(self, url, assignment: str):
+    async def get_lineitem_id_from_assignment(self, url, assignment: str):
         """
         未登録のlineitemの場合、Noneが返る
         """
         headers = {'Accept': 'application/vnd.ims.lis.v2.lineitemcontainer+json'}
-        response = self._request_lms(url, headers)
+        response = await self._request_lms(url, headers)
         for lineitem in response.json():
             if lineitem['label'] == assignment:
                 lineitem_id = lineitem['id']
                 return lineitem_id
 
-    def register_lineitem(self, url: str, lineitem: LineItem):
+    async def register_lineitem(self, url: str, lineitem: LineItem):
         headers = {'Accept': 'application/vnd.ims.lis.v2.lineitem+json',
                    "Content-Type": "application/vnd.ims.lis.v2.lineitem+json"}
-        response = self._request_lms(url, headers, method="POST",
-                                     data=lineitem.model_dump_json())
+        response = await self._request_lms(url, headers, method="POST",
+                                           data=lineitem.model_dump_json())
         return response
 
-    def register_score(self, url: str, score: Score):
+    async def register_score(self, url: str, score: Score):
         headers = {'Accept': 'application/vnd.ims.lis.v1.score+json',
                    'Content-Type': 'application/vnd.ims.lis.v1.score+json',}
-        response = self._request_lms(url, headers, method="POST",
-                                     data=score.model_dump_json())
+        # 成績はtimestampが新しいものに置き換えられるため、再送しても重複しない
+        response = await self._request_lms(url, headers, method="POST",
+                                           data=score.model_dump_json(),
+                                           retry=True)
         return response
 
+    async def publish_score(self, semaphore: asyncio.Semaphore, url: str,
+                            student: str, score: Score) -> dict:
+        """学生1人分の成績を送信し、結果を返す
+        """
+        async with semaphore:
+            try:
+                response = await self.register_score(url, score)
+            except Exception as e:
+                self.log.error(f"Score register failed: {student} {e}")
+                return dict(student=student, status=ScoreResult.FAILED,
+                            code=None, reason=str(e))
+
+        if not response.ok:
+            self.log.error(f"Score register failed: {student} {response.status_code} {response.text}")
+            return dict(student=student, status=ScoreResult.FAILED,
+                        code=response.status_code, reason=response.reason)
+        return dict(student=student, status=ScoreResult.REGISTERED,
+                    code=response.status_code, reason="")
+
     @web.authenticated
     async def post(self):
         user = self.get_current_user()
         self.json_data = escape.json_decode(self.request.body)
-        global lms_token
         try:
             assignment_name = self.json_data['assignment']
         except KeyError as e:
@@ -707,7 +1366,7 @@ class TeacherToolsUpdateHandler(TeacherToolsOutputHandler):
         ags_url_query = parts.query
 
         # Search lineitem(column)
-        lineitem_id = self.get_lineitem_id_from_assignment(
+        lineitem_id = await self.get_lineitem_id_from_assignment(
             f'{ags_url_base}?{ags_url_query}', assignment.name)
 
         # Add lineitem(column)
@@ -722,7 +1381,7 @@ class TeacherToolsUpdateHandler(TeacherToolsOutputHandler):
                     HTTPStatus.NOT_ACCEPTABLE, e.errors()
                 )
 
-            response = self.register_lineitem(f'{ags_url_base}?{ags_url_query}', lineitem)
+            response = await self.register_lineitem(f'{ags_url_base}?{ags_url_query}', lineitem)
 
             if HTTPStatus.CREATED != response.status_code:
                 raise web.HTTPError(
@@ -740,15 +1399,26 @@ class TeacherToolsUpdateHandler(TeacherToolsOutputHandler):
                             user['name'],
                             homedir=self.homedir)
 
+        uids = await IOLoop.current().run_in_executor(
+            None, self.get_uids, [grade['student'] for grade in grades])
+
+        # 成績の送信はags_concurrency件まで並列に行い、失敗しても残りの学生の送信を続ける
+        semaphore = asyncio.Semaphore(self.ags_concurrency)
+        results = list()
+        tasks = list()
         for grade in grades:
-            uid = self.get_uid(grade['student'])
+            # 非learner（教師ユーザ）の成績が入っているとMoodle側で400エラーになるため、除く
+            if user['name'] == grade['student']:
+                continue
+
+            uid = uids.get(grade['student'])
 
             if uid is None:
                 self.log.warning(f'User {grade["student"]} skipped because user info is not exist (maybe the user never logged in).')
-                continue
-
-            # 非learner（教師ユーザ）の成績が入っているとMoodle側で400エラーになるため、除く
-            if user['name'] == grade['student']:
+                results.append(dict(student=grade['student'],
+                                    status=ScoreResult.SKIPPED,
+                                    code=None,
+                                    reason="User info is not exist"))
                 continue
 
             # TODO uidのprefix指定オプション対応(現状固定で、moodleでのid+1000がuid)
@@ -759,18 +1429,27 @@ class TeacherToolsUpdateHandler(TeacherToolsOutputHandler):
                     scoreMaximum=grade['max_score'],
                 )
             except ValidationError as e:
-                raise web.HTTPError(
-                    HTTPStatus.NOT_ACCEPTABLE, e.errors()
-                )
+                results.append(dict(student=grade['student'],
+                                    status=ScoreResult.FAILED,
+                                    code=HTTPStatus.NOT_ACCEPTABLE,
+                                    reason=str(e.errors())))
+                continue
 
-            response = self.register_score(
+            tasks.append(self.publish_score(
+                semaphore,
                 f'{ags_url_base}/scores?{ags_url_query}',
-                score)
-            if not (200 <= response.status_code < 300):
-                raise web.HTTPError(
-                    response.status_code, "Score register failed"
-                )
-        self.json_output()
+                grade['student'],
+                score))
+        results.extend(await asyncio.gather(*tasks))
+        self.log.debug(f"LMS request metrics: {self.lms_client.metrics.snapshot()}")
+
+        res = dict()
+        res['assignment'] = assignment.name
+        res['results'] = sorted(results, key=lambda r: r['student'])
+        for status in (ScoreResult.REGISTERED, ScoreResult.SKIPPED,
+                       ScoreResult.FAILED):
+            res[status] = len([r for r in results if r['status'] == status])
+        self.json_output(output=res)
 
 
 class TeacherToolsViewHandler(TeacherToolsHandler):
@@ -0,0 +1,183 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import uuid
+
+from tornado.ioloop import IOLoop
+
+
+class JobStatus():
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+def _as_set(assignment: str | list | None) -> set | None:
+    if assignment is None:
+        return None
+    if isinstance(assignment, str):
+        return {assignment}
+    return set(assignment)
+
+
+class LogCollectJob():
+    """ログ収集ジョブ
+
+    keyは(教師ユーザ名, コース名)。paramsはログ収集処理に渡すキーワード引数で、
+    収集範囲としてassignment/dt_from/dt_toを参照する。
+    progressはワーカースレッドから更新される進捗件数。
+    """
+
+    def __init__(self, key: tuple, params: dict):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.params = params
+        self.status = JobStatus.PENDING
+        self.progress = dict()
+        self.result = None
+        self.error = None
+        self.created_at = datetime.now(timezone.utc)
+        self.started_at = None
+        self.finished_at = None
+        self.func = None
+        self.future = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JobStatus.DONE, JobStatus.FAILED)
+
+    def covers(self, params: dict) -> bool:
+        """paramsで指定された収集範囲が、このジョブの収集範囲に含まれるか
+
+        課題の指定が無い(None)場合は全ての課題、dt_fromの指定が無い場合は
+        最古、dt_toの指定が無い場合は現在時刻までを対象とみなす。
+        """
+        own_assignments = _as_set(self.params.get('assignment'))
+        assignments = _as_set(params.get('assignment'))
+        if own_assignments is not None and \
+           (assignments is None or not assignments <= own_assignments):
+            return False
+
+        own_dt_from = self.params.get('dt_from')
+        dt_from = params.get('dt_from')
+        if own_dt_from is not None and (dt_from is None or dt_from < own_dt_from):
+            return False
+
+        own_dt_to = self.params.get('dt_to')
+        dt_to = params.get('dt_to')
+        if own_dt_to is not None and (dt_to is None or dt_to > own_dt_to):
+            return False
+
+        return True
+
+    def to_dict(self) -> dict:
+        return dict(
+            job_id=self.id,
+            course=self.key[1],
+            status=self.status,
+            progress=self.progress.copy(),
+            error=self.error,
+            created_at=self.created_at.isoformat(),
+            started_at=self.started_at.isoformat() if self.started_at else None,
+            finished_at=self.finished_at.isoformat() if self.finished_at else None,
+        )
+
+
+class LogCollectJobManager():
+    """ログ収集ジョブをスレッドプールで実行する
+
+    同じコースに対して実行中・実行待ちのジョブがあり、その収集範囲に含まれる要求であれば
+    新たにジョブを作らず、そのジョブに合流させる。
+    同じコースのジョブはDBのロック競合を避けるため、1件ずつ実行する。
+    後続のジョブは先行するジョブの完了後にスレッドプールへ投入するため、
+    実行待ちのジョブがワーカースレッドを占有することはない。
+    メソッドはIOLoopのスレッドから呼び出すこと。
+    """
+
+    def __init__(self, max_workers: int = 2, max_finished_jobs: int = 100):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='log_collect')
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs: OrderedDict[str, LogCollectJob] = OrderedDict()
+        # key -> 未完了のジョブ。先頭が実行中のジョブで、以降は投入順の実行待ち
+        self.inflight: dict[tuple, list[LogCollectJob]] = dict()
+
+    def submit(self, key: tuple, params: dict, func) -> LogCollectJob:
+        """ジョブを登録する
+
+        :param key: (教師ユーザ名, コース名)
+        :type key: tuple
+        :param params: funcに渡すキーワード引数
+        :type params: dict
+        :param func: ログ収集処理。progressキーワード引数を受け取ること
+        :type func: callable
+        :returns: 登録した(または合流した)ジョブ
+        :rtype: LogCollectJob
+        """
+        queue = self.inflight.setdefault(key, list())
+        for job in queue:
+            if job.covers(params):
+                return job
+
+        job = LogCollectJob(key, params)
+        job.func = func
+        job.future = asyncio.get_running_loop().create_future()
+        # 結果を待たないリクエストもあるため、例外を回収しておく
+        job.future.add_done_callback(
+            lambda f: f.cancelled() or f.exception())
+        self.jobs[job.id] = job
+        queue.append(job)
+        if len(queue) == 1:
+            self._start(job)
+        return job
+
+    def get(self, job_id: str) -> LogCollectJob | None:
+        return self.jobs.get(job_id)
+
+    def _start(self, job: LogCollectJob):
+        future = IOLoop.current().run_in_executor(self.executor, self._run, job)
+        future.add_done_callback(lambda f: self._finish(job, f))
+
+    def _run(self, job: LogCollectJob):
+        job.status = JobStatus.RUNNING
+        job.started_at = datetime.now(timezone.utc)
+        try:
+            job.result = job.func(progress=job.progress, **job.params)
+        except Exception as e:
+            job.status = JobStatus.FAILED
+            job.error = str(e)
+            raise
+        else:
+            job.status = JobStatus.DONE
+        finally:
+            job.finished_at = datetime.now(timezone.utc)
+        return job.result
+
+    def _finish(self, job: LogCollectJob, future):
+        job.func = None
+        if future.cancelled():
+            job.status = JobStatus.FAILED
+            job.error = 'cancelled'
+            job.finished_at = datetime.now(timezone.utc)
+            if not job.future.done():
+                job.future.cancel()
+        elif future.exception() is not None:
+            if not job.future.done():
+                job.future.set_exception(future.exception())
+        elif not job.future.done():
+            job.future.set_result(future.result())
+
+        # 同じコースの次のジョブを開始する
+        queue = self.inflight.get(job.key, list())
+        if job in queue:
+            queue.remove(job)
+        if queue:
+            self._start(queue[0])
+        else:
+            self.inflight.pop(job.key, None)
+
+        finished = [job_id for job_id, j in self.jobs.items() if j.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
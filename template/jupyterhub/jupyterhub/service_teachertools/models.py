@@ -1,12 +1,42 @@
+from collections import OrderedDict
 from datetime import datetime, timezone
+import itertools
+import os
+import threading
 
 from pydantic import BaseModel, ConfigDict
 from sqlmodel import Field, Relationship, SQLModel, create_engine, Session
-from sqlalchemy import Column, JSON
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy import (BigInteger, Column, Integer, JSON, String, and_, func,
+                        insert, inspect, select, text)
+from sqlalchemy.dialects import mysql
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.schema import (CreateIndex, CreateTable, Index,
+                               PrimaryKeyConstraint, UniqueConstraint)
+from sqlalchemy.types import TypeDecorator
 from typing import Dict
 
 
+# コースDBごとのEngineを保持する数の上限
+ENGINE_CACHE_SIZE = 32
+
+_engines: OrderedDict[str, Engine] = OrderedDict()
+_engines_lock = threading.Lock()
+# インデックスの追加などのスキーマ更新を済ませたDBのURL -> (DBファイルの識別値, 世代番号)
+_initialized_urls: dict[str, tuple] = dict()
+_db_generations = itertools.count()
+
+# MySQL/MariaDB(InnoDB)のインデックスのキー長の上限(バイト)
+MYSQL_MAX_KEY_BYTES = 3072
+# 文字列カラムを4つ以上含むインデックスは、utf8mb4(1文字4バイト)では上限を超えるため、
+# MySQL/MariaDBでは先頭の文字数に限定したプレフィックスインデックスとする
+LOG_INDEX_PREFIX_LENGTHS = {
+    "assignment": 191,
+    "student_id": 191,
+    "cell_id": 191,
+    "log_execute_reply_status": 32,
+}
+
+
 def default_timestamp():
     return datetime.now(timezone.utc).isoformat(timespec="seconds").replace('+00:00', 'Z')
 
@@ -42,6 +72,7 @@ class Cell(CellBase, table=True):
                                      cascade_delete=True)
     __table_args__ = (
         UniqueConstraint("id", "assignment"),
+        Index("ix_cell_assignment", "assignment"),
     )
 
 
@@ -120,9 +151,86 @@ class Log(LogBase, table=True):
 
     __table_args__ = (
         UniqueConstraint("assignment", "student_id", "cell_id", "log_sequence"),
+        # 学生・セルごとの最新ログとその実行結果(進捗表示)
+        Index("ix_log_latest_status", "assignment", "student_id", "cell_id",
+              "log_sequence", "log_execute_reply_status",
+              mysql_length=LOG_INDEX_PREFIX_LENGTHS,
+              mariadb_length=LOG_INDEX_PREFIX_LENGTHS),
+        # 実行結果ごとの時系列(完了率の推移)
+        Index("ix_log_status_end", "assignment", "log_execute_reply_status",
+              "log_end", "student_id", "cell_id",
+              mysql_length=LOG_INDEX_PREFIX_LENGTHS,
+              mariadb_length=LOG_INDEX_PREFIX_LENGTHS),
+        # セルごとの期間指定(取り組み時間)
+        Index("ix_log_cell_end", "assignment", "cell_id", "log_end"),
     )
 
 
+class LatestLogBase(SQLModel):
+    assignment: str = Field(max_length=255, primary_key=True)
+    student_id: str = Field(max_length=255, primary_key=True)
+    cell_id: str = Field(max_length=255, primary_key=True)
+    log_sequence: int
+    log_execute_reply_status: str | None = Field(default=None, max_length=255)
+    log_start: datetime | None = Field(default=None)
+    log_end: datetime | None = Field(default=None)
+
+
+class LatestLogCreate(LatestLogBase):
+
+    def to_dict(self):
+        return dict(
+            assignment=self.assignment,
+            student_id=self.student_id,
+            cell_id=self.cell_id,
+            log_sequence=self.log_sequence,
+            log_execute_reply_status=self.log_execute_reply_status,
+            log_start=self.log_start,
+            log_end=self.log_end
+        )
+
+
+class LatestLog(LatestLogBase, table=True):
+    """学生・セルごとの最新のログ
+
+    logテーブルのうち、(assignment, student_id, cell_id)ごとに
+    log_sequenceが最大の行の内容を保持する。ログの登録時に併せて更新する。
+    """
+    __tablename__ = "latest_log"
+
+
+class ScanStateBase(SQLModel):
+    path: str = Field(max_length=512, primary_key=True)
+    mtime_ns: int | None = Field(default=None, sa_column=Column(BigInteger))
+    size: int | None = Field(default=None, sa_column=Column(BigInteger))
+    log_sequence: int = Field(default=-1)
+    log_offset: int | None = Field(default=None, sa_column=Column(BigInteger))
+
+
+class ScanStateCreate(ScanStateBase):
+
+    def to_dict(self):
+        return dict(
+            path=self.path,
+            mtime_ns=self.mtime_ns,
+            size=self.size,
+            log_sequence=self.log_sequence,
+            log_offset=self.log_offset
+        )
+
+
+class ScanState(ScanStateBase, table=True):
+    """ログファイルの取り込み状況
+
+    pathはホームディレクトリからの相対パス。
+    log_sequenceは、先頭から連続してDBに登録済みのログの最終インデックス。
+    log_offsetは、そのログの直後のファイル上のバイト位置。次回収集時はここから読み取る。
+    mtime_ns/sizeは全てのログを登録済みの場合のみ記録し、
+    次回収集時にファイルが変更されていなければ読み取りを省略する。
+    """
+    __tablename__ = "scan_state"
+
+
 class LineItem(BaseModel):
     model_config = ConfigDict(strict=True)
 
@@ -146,9 +254,122 @@ class Score(BaseModel):
     gradingProgress: str | None = "FullyGraded"
 
 
-def init_db(url):
-    engine = create_engine(url)
+def get_engine(url: str) -> Engine:
+    """DBのURLごとに共有するEngineを返す
+
+    リクエストをまたいで再利用する。保持数がENGINE_CACHE_SIZEを超えた場合、
+    最も長く使われていないEngineから破棄する。
+
+    :param url: DBのURL
+    :type url: string
+    :returns: Engine
+    :rtype: sqlalchemy.engine.Engine
+    """
+    with _engines_lock:
+        engine = _engines.get(url)
+        if engine is not None:
+            _engines.move_to_end(url)
+            return engine
+
+        engine = create_engine(url)
+        _engines[url] = engine
+        while len(_engines) > ENGINE_CACHE_SIZE:
+            _, evicted = _engines.popitem(last=False)
+            evicted.dispose()
+        return engine
+
+
+def init_db(url) -> tuple:
+    """テーブルを作成する
+
+    テーブル作成後に追加したカラム・インデックスは、既存のDBにも作成する。
+    スキーマの確認はプロセス内でDBごとに1回のみ行う。
+    ただし、SQLiteのDBファイルが削除・再作成された場合は再度行う。
+
+    :returns: DBを識別する値(URL, 世代番号)。DBファイルを作り直すたびに世代番号が変わる
+    :rtype: tuple
+    """
+    file_id = get_db_file_id(url)
+    if url in _initialized_urls:
+        initialized_file_id, generation = _initialized_urls[url]
+        if initialized_file_id == file_id:
+            return (url, generation)
+        # 削除されたDBファイルを開いたままの接続を破棄する
+        get_engine(url).dispose()
+    engine = get_engine(url)
+    latest_log_exists = inspect(engine).has_table(LatestLog.__tablename__)
     SQLModel.metadata.create_all(engine)
+    add_missing_columns(engine)
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    if not latest_log_exists:
+        backfill_latest_log(engine)
+    generation = next(_db_generations)
+    _initialized_urls[url] = (get_db_file_id(url), generation)
+    return (url, generation)
+
+
+def get_db_file_id(url: str) -> tuple | None:
+    """SQLiteのDBファイルを識別する値(デバイス番号, inode番号)を返す
+
+    SQLite以外のDBや、DBファイルが存在しない場合はNoneを返す。
+
+    :param url: DBのURL
+    :type url: string
+    :returns: (デバイス番号, inode番号)
+    :rtype: tuple
+    """
+    db_url = make_url(url)
+    if db_url.get_backend_name() != "sqlite" or \
+       db_url.database in (None, "", ":memory:"):
+        return None
+    try:
+        stat = os.stat(db_url.database)
+    except FileNotFoundError:
+        return None
+    return (stat.st_dev, stat.st_ino)
+
+
+def add_missing_columns(engine: Engine):
+    """モデルに定義されていて、DBのテーブルに無いカラムを追加する
+
+    既存の行があるため、テーブル作成後に追加するカラムはNULLを許容すること。
+    """
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                conn.execute(text(
+                    f"ALTER TABLE {quote(table.name)} ADD COLUMN "
+                    f"{quote(column.name)} {column.type.compile(engine.dialect)}"))
+
+
+def backfill_latest_log(engine: Engine):
+    """登録済みのログからlatest_logテーブルの内容を作成する
+
+    latest_logテーブル導入前に作成されたDB向け。
+    """
+    latest = select(
+        Log.assignment, Log.student_id, Log.cell_id,
+        func.max(Log.log_sequence).label("log_sequence"),
+    ).group_by(Log.assignment, Log.student_id, Log.cell_id).subquery()
+    columns = ["assignment", "student_id", "cell_id", "log_sequence",
+               "log_execute_reply_status", "log_start", "log_end"]
+    stmt = insert(LatestLog).from_select(
+        columns,
+        select(*[getattr(Log, c) for c in columns]).join(
+            latest,
+            and_(Log.assignment == latest.c.assignment,
+                 Log.student_id == latest.c.student_id,
+                 Log.cell_id == latest.c.cell_id,
+                 Log.log_sequence == latest.c.log_sequence)))
+    with engine.begin() as conn:
+        conn.execute(stmt)
 
 
 def test():
@@ -158,5 +379,50 @@ def test():
         print(f'engine is {session.bind.dialect.name}')
 
 
+def test_mysql_ddl():
+    """MySQL/MariaDB向けのDDLを作成し、インデックスのキー長が上限内であることを確認する
+
+    DBへの接続は不要。文字列カラムはutf8mb4(1文字4バイト)として計算する。
+    """
+    for dialect in (mysql.dialect(), mysql.dialect(is_mariadb=True)):
+        prefix = "mariadb" if dialect.is_mariadb else "mysql"
+        for table in SQLModel.metadata.sorted_tables:
+            print(CreateTable(table).compile(dialect=dialect))
+            keys = [(index.name, index.expressions,
+                     index.dialect_options[prefix]["length"] or {})
+                    for index in table.indexes]
+            keys += [(constraint.name or f"{table.name} unique/primary key",
+                      constraint.columns, {})
+                     for constraint in table.constraints
+                     if isinstance(constraint,
+                                   (UniqueConstraint, PrimaryKeyConstraint))]
+            for name, columns, lengths in keys:
+                key_bytes = sum(_mysql_key_bytes(column, lengths, dialect)
+                                for column in columns)
+                assert key_bytes <= MYSQL_MAX_KEY_BYTES, \
+                    f"{name}: {key_bytes} bytes > {MYSQL_MAX_KEY_BYTES}"
+            for index in table.indexes:
+                print(CreateIndex(index).compile(dialect=dialect))
+    print("ok")
+
+
+def _mysql_key_bytes(column, lengths: dict, dialect) -> int:
+    """インデックスのキーに占めるカラムのバイト数(概算)"""
+    column_type = column.type
+    if isinstance(column_type, TypeDecorator):
+        column_type = column_type.load_dialect_impl(dialect)
+    if column.name in lengths:
+        return lengths[column.name] * 4
+    if isinstance(column_type, String):
+        return (column_type.length or 255) * 4
+    if isinstance(column_type, BigInteger):
+        return 8
+    if isinstance(column_type, Integer):
+        return 4
+    # DATETIME(5バイト)、FLOATなど
+    return 8
+
+
 if __name__ == '__main__':
     test()
+    test_mysql_ddl()
@@ -0,0 +1,241 @@
+import asyncio
+from datetime import datetime, timezone
+import hashlib
+import json
+import time
+
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
+from sqlmodel import Session
+
+import crud
+from jobs import LogCollectJobManager
+from models import get_engine
+
+
+def build_progress(log_db_url: str, course: str, assignment: str) -> dict:
+    """課題の進捗状況(学生×セルごとの最新の実行結果)を作成する
+
+    statusは学生ごとに、cellsと同じ順で実行結果('ok'/'error'、未実行は'')を並べたもの。
+
+    :param log_db_url: ログDBのURL
+    :type log_db_url: string
+    :param course: コース名
+    :type course: string
+    :param assignment: 課題名
+    :type assignment: string
+    :returns: 進捗状況 e.g. {'course': 'c1', 'assignment': 'a1', 'students': ['s1'],
+              'cells': [{'id': 'cell01', 'notebook_name': 'nb.ipynb', 'section': '1',
+              'jupyter_cell_id': 'abc'}], 'status': [['ok']], 'updated_at': '...'}
+    :rtype: dict
+    """
+    with Session(get_engine(log_db_url)) as session:
+        students, cells, latest_logs = crud.get_progress(
+            session=session, assignment=assignment)
+
+    student_index = {student_id: i for i, student_id in enumerate(students)}
+    cell_index = {cell.id: i for i, cell in enumerate(cells)}
+    status = [[''] * len(cells) for _ in students]
+    for latest_log in latest_logs:
+        i = student_index.get(latest_log.student_id)
+        j = cell_index.get(latest_log.cell_id)
+        if i is None or j is None:
+            continue
+        status[i][j] = latest_log.log_execute_reply_status or ''
+
+    return dict(
+        course=course,
+        assignment=assignment,
+        students=list(students),
+        cells=[dict(id=cell.id,
+                    notebook_name=cell.notebook_name,
+                    section=cell.section,
+                    jupyter_cell_id=cell.jupyter_cell_id)
+               for cell in cells],
+        status=status,
+        updated_at=datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    )
+
+
+def diff_progress(old: dict, new: dict) -> list | None:
+    """2つの進捗状況の間で実行結果が変わったセルを返す
+
+    :param old: 変更前の進捗状況
+    :type old: dict
+    :param new: 変更後の進捗状況
+    :type new: dict
+    :returns: [学生名, セルID, 実行結果]のリスト。学生・セルの構成が変わった場合はNone
+    :rtype: list
+    """
+    if old['students'] != new['students'] or old['cells'] != new['cells']:
+        return None
+    return [[student_id, new['cells'][i]['id'], status]
+            for student_id, old_row, new_row in zip(
+                new['students'], old['status'], new['status'])
+            if old_row != new_row
+            for i, status in enumerate(new_row) if status != old_row[i]]
+
+
+class ProgressSnapshot():
+    """進捗状況のスナップショット
+
+    bodyはレスポンスとして返すJSON。etagは進捗状況の内容から作成するため、
+    作り直しても内容が変わっていなければ同じ値になる。
+    changesは、previous_etagのスナップショットから実行結果が変わったセル(diff_progress)。
+    """
+
+    def __init__(self, progress: dict, previous=None):
+        self.progress = progress
+        self.body = json.dumps(progress, ensure_ascii=False,
+                               separators=(',', ':')).encode('utf-8')
+        content = {k: v for k, v in progress.items() if k != 'updated_at'}
+        digest = hashlib.sha256(
+            json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+        self.etag = f'"{digest[:32]}"'
+        self.created_at = time.monotonic()
+        self.previous_etag = None
+        self.changes = None
+        if previous is not None:
+            self.previous_etag = previous.etag
+            self.changes = diff_progress(previous.progress, progress)
+
+
+class ProgressSnapshotManager():
+    """課題ごとの進捗状況のスナップショットを作成・共有する
+
+    keyは(教師ユーザ名, コース名, 課題名)。interval秒以内に作成したスナップショットは
+    作り直さず、全ての閲覧者で共有する。作り直す際はログ収集ジョブを実行してから
+    latest_logテーブルを読み取る。作り直し中の要求は、その完了を待って結果を共有する。
+    watch()で変更を待ち受けている閲覧者がいる間は、push_interval秒ごとに作り直す。
+    作り直して内容が変わった場合は、作り直しの契機によらず待ち受けている閲覧者に通知する。
+    メソッドはIOLoopのスレッドから呼び出すこと。
+
+    :param jobs: ログ収集ジョブの実行に使うLogCollectJobManager
+    :type jobs: LogCollectJobManager
+    :param interval: スナップショットを作り直す間隔(秒)
+    :type interval: float
+    :param push_interval: 変更を待ち受けている閲覧者がいる場合に、スナップショットを作り直す間隔(秒)
+    :type push_interval: float
+    """
+
+    def __init__(self, jobs: LogCollectJobManager, interval: float = 10,
+                 push_interval: float = 2):
+        self.jobs = jobs
+        self.interval = interval
+        self.push_interval = push_interval
+        self.snapshots: dict[tuple, ProgressSnapshot] = dict()
+        self.refreshing: dict[tuple, asyncio.Future] = dict()
+        self.watchers: dict[tuple, set[asyncio.Event]] = dict()
+        self.push_loops: dict[tuple, asyncio.Task] = dict()
+
+    def get_cached(self, key: tuple,
+                   max_age: float | None = None) -> ProgressSnapshot | None:
+        """max_age秒以内に作成したスナップショットを返す。無ければNoneを返す
+
+        max_ageの指定が無い場合はintervalを使う。
+        """
+        max_age = max_age if max_age is not None else self.interval
+        snapshot = self.snapshots.get(key)
+        if snapshot is None or \
+           time.monotonic() - snapshot.created_at >= max_age:
+            return None
+        return snapshot
+
+    async def get(self, key: tuple, params: dict, func,
+                  max_age: float | None = None) -> ProgressSnapshot:
+        """スナップショットを返す。古い場合は作り直す
+
+        :param key: (教師ユーザ名, コース名, 課題名)
+        :type key: tuple
+        :param params: ログ収集処理に渡すキーワード引数
+        :type params: dict
+        :param func: ログ収集処理。ログDBのURLを返すこと
+        :type func: callable
+        :param max_age: 作り直さずに返すスナップショットの経過秒数。指定が無い場合はinterval
+        :type max_age: float
+        :returns: スナップショット
+        :rtype: ProgressSnapshot
+        """
+        snapshot = self.get_cached(key, max_age)
+        if snapshot is not None:
+            return snapshot
+
+        future = self.refreshing.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._refresh(key, params, func))
+            self.refreshing[key] = future
+            future.add_done_callback(lambda f: self.refreshing.pop(key, None))
+        # 要求元の切断で作り直しが中断されないようにする
+        return await asyncio.shield(future)
+
+    async def _refresh(self, key: tuple, params: dict,
+                       func) -> ProgressSnapshot:
+        _, course, assignment = key
+        job = self.jobs.submit(key[:2], params, func)
+        log_db_url = await job.future
+        progress = await IOLoop.current().run_in_executor(
+            None, build_progress, log_db_url, course, assignment)
+
+        previous = self.snapshots.get(key)
+        snapshot = ProgressSnapshot(progress, previous)
+        if previous is not None and previous.etag == snapshot.etag:
+            # 内容が変わっていなければ、前回のレスポンスを使い続ける
+            previous.created_at = snapshot.created_at
+            return previous
+        self.snapshots[key] = snapshot
+        for event in self.watchers.get(key, set()):
+            event.set()
+        return snapshot
+
+    async def watch(self, key: tuple, params: dict, func,
+                    timeout: float | None = None):
+        """スナップショットが変わるたびに返す非同期ジェネレータ
+
+        最初に現在のスナップショットを返し、以降は作り直して内容が変わった場合のみ返す。
+        timeout秒の間変更が無い場合はNoneを返す。
+        引数はget()と同じ。利用を終える際はaclose()を呼び出すこと。
+        """
+        snapshot = await self.get(key, params, func,
+                                  max_age=self.push_interval)
+        event = asyncio.Event()
+        self.watchers.setdefault(key, set()).add(event)
+        if key not in self.push_loops:
+            self.push_loops[key] = asyncio.ensure_future(
+                self._push_loop(key, params, func))
+        try:
+            yield snapshot
+            while True:
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                event.clear()
+                current = self.snapshots.get(key)
+                if current is not None and current is not snapshot:
+                    snapshot = current
+                    yield snapshot
+        finally:
+            watchers = self.watchers.get(key, set())
+            watchers.discard(event)
+            if not watchers:
+                self.watchers.pop(key, None)
+
+    async def _push_loop(self, key: tuple, params: dict, func):
+        """閲覧者がいる間、push_interval秒ごとにスナップショットを作り直す
+
+        閲覧者への通知は_refresh()で行う。
+        """
+        try:
+            while True:
+                await asyncio.sleep(self.push_interval)
+                if not self.watchers.get(key):
+                    break
+                try:
+                    await self.get(key, params, func,
+                                   max_age=self.push_interval)
+                except Exception:
+                    # 閲覧者には通知せず、次の間隔で再度作り直す
+                    app_log.exception(f"Failed to refresh progress: {key}")
+        finally:
+            self.push_loops.pop(key, None)
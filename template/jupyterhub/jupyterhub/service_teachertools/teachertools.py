@@ -11,14 +11,21 @@ from jupyterhub.log import CoroutineLogFormatter
 from jupyterhub.services.auth import HubOAuthCallbackHandler
 from jupyterhub.utils import url_path_join
 from tornado import ioloop, web
-from traitlets import Bool, Dict, Integer, List, Unicode, default
+from traitlets import Bool, Dict, Float, Integer, List, Unicode, default
 from traitlets.config import Application
 
 from handlers import (
     TeacherToolsUpdateHandler,
     TeacherToolsViewHandler,
     TeacherToolsLogDBHandler,
+    TeacherToolsLogJobHandler,
+    TeacherToolsMetricsHandler,
+    TeacherToolsProgressHandler,
+    TeacherToolsProgressEventHandler,
 )
+from jobs import LogCollectJobManager
+from progress import ProgressSnapshotManager
+from lms_client import LMS_POOL_MAXSIZE, configure_lms_client
 
 
 class TeacherToolsService(Application):
@@ -137,6 +144,75 @@ class TeacherToolsService(Application):
         config=True,
     )
 
+    log_collect_workers = Integer(
+        2,
+        help=dedent(
+            """
+            Number of worker threads running log collection jobs.
+            """
+        ).strip(),
+    ).tag(
+        config=True,
+    )
+
+    log_scan_workers = Integer(
+        8,
+        help=dedent(
+            """
+            Number of threads reading students' log files in parallel
+            during a log collection job.
+            """
+        ).strip(),
+    ).tag(
+        config=True,
+    )
+
+    ags_concurrency = Integer(
+        8,
+        help=dedent(
+            """
+            Maximum number of scores posted to LMS concurrently.
+            """
+        ).strip(),
+    ).tag(
+        config=True,
+    )
+
+    ags_max_retries = Integer(
+        3,
+        help=dedent(
+            """
+            Number of retries of a LMS request which failed with 429 or 5xx.
+            """
+        ).strip(),
+    ).tag(
+        config=True,
+    )
+
+    progress_interval = Float(
+        10,
+        help=dedent(
+            """
+            Seconds a progress snapshot of an assignment is shared by all
+            viewers before logs are collected again to refresh it.
+            """
+        ).strip(),
+    ).tag(
+        config=True,
+    )
+
+    progress_push_interval = Float(
+        2,
+        help=dedent(
+            """
+            Seconds between log collections of an assignment while dashboards
+            are connected to its progress event stream.
+            """
+        ).strip(),
+    ).tag(
+        config=True,
+    )
+
     _log_formatter_cls = CoroutineLogFormatter
 
     @default("log_datefmt")
@@ -172,6 +248,15 @@ class TeacherToolsService(Application):
         except binascii.Error:
             cookie_secret = raw
 
+        # 成績の送信をags_concurrency件まで並列に行えるよう、接続数をags_concurrency以上にする。
+        # LmsClientは冪等なメソッドのみ再送する。成績の送信(POST)の再送はhandlerで行う。
+        # LTIのトークン取得(lti.get_lms_client)も同じLmsClientを使う
+        self.lms_client = configure_lms_client(
+            pool_maxsize=max(LMS_POOL_MAXSIZE, self.ags_concurrency),
+            max_retries=self.ags_max_retries)
+
+        log_collect_jobs = LogCollectJobManager(
+            max_workers=self.log_collect_workers)
         self.settings = {
             "cookie_secret": cookie_secret,
             "static_path": os.path.join(self.data_files_path, "static"),
@@ -180,6 +265,11 @@ class TeacherToolsService(Application):
             "xsrf_cookies": True,
             'homedir': self.homedir,
             'hub_api_url': self.hub_api_url,
+            'log_collect_jobs': log_collect_jobs,
+            'log_scan_workers': self.log_scan_workers,
+            'progress_snapshots': ProgressSnapshotManager(
+                log_collect_jobs, interval=self.progress_interval,
+                push_interval=self.progress_push_interval),
         }
 
         if "xsrf_cookie_kwargs" not in self.settings:
@@ -202,12 +292,31 @@ class TeacherToolsService(Application):
                     TeacherToolsUpdateHandler,
                     dict(lms_token_endpoint=self.lms_token_endpoint,
                          lms_client_id=self.lms_client_id,
+                         lms_client=self.lms_client,
+                         ags_concurrency=self.ags_concurrency,
+                         ags_max_retries=self.ags_max_retries,
                          )
                 ),
                 (
                     self.service_prefix + r"api/log_collect",
                     TeacherToolsLogDBHandler,
                 ),
+                (
+                    self.service_prefix + r"api/log_collect/([0-9a-f]+)",
+                    TeacherToolsLogJobHandler,
+                ),
+                (
+                    self.service_prefix + r"api/progress/([^/]+)",
+                    TeacherToolsProgressHandler,
+                ),
+                (
+                    self.service_prefix + r"api/progress/([^/]+)/events",
+                    TeacherToolsProgressEventHandler,
+                ),
+                (
+                    self.service_prefix + r"metrics",
+                    TeacherToolsMetricsHandler,
+                ),
                 (
                     self.service_prefix + r"oauth_callback",
                     HubOAuthCallbackHandler
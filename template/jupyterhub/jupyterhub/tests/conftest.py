@@ -0,0 +1,13 @@
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [
+    os.path.join(TESTS_DIR, '..'),
+    os.path.join(TESTS_DIR, '..', 'service_teachertools'),
+]
+
+import lti  # noqa: E402
+
+# handlers.pyはimport時にLTIの鍵ファイル(/etc/jupyterhub)を読み取る・作成するため置き換える
+lti.confirm_key_exist = lambda path=None: (b'', b'')
@@ -0,0 +1,42 @@
+import json
+import tempfile
+
+from tornado import web
+from tornado.testing import AsyncHTTPTestCase
+
+import handlers
+from jobs import LogCollectJobManager
+from progress import ProgressSnapshotManager
+
+
+class ProgressHandler(handlers.TeacherToolsProgressHandler):
+
+    def get_current_user(self):
+        return {'name': 'teacher01'}
+
+
+class TestDirectoryNotFound(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.homedir = tempfile.TemporaryDirectory()
+        jobs = LogCollectJobManager(max_workers=1)
+        return web.Application(
+            [(r'/api/progress/([^/]+)', ProgressHandler)],
+            hub_api_url='',
+            homedir=self.homedir.name,
+            log_collect_jobs=jobs,
+            log_scan_workers=1,
+            progress_snapshots=ProgressSnapshotManager(jobs),
+        )
+
+    def tearDown(self):
+        super().tearDown()
+        self.homedir.cleanup()
+
+    def test_unknown_course_returns_reason(self):
+        response = self.fetch('/api/progress/assignment01?course=unknown')
+        assert response.code == 400
+        assert json.loads(response.body) == {
+            'status': 400,
+            'reason': 'directory not found: ~/nbgrader/unknown',
+        }
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta, timezone
+import time
+
+import pytest
+
+from handlers import jst2datetime
+
+
+def jst2datetime_strptime(dt: str) -> datetime:
+    """strptimeによる変換(jst2datetimeの最適化前の実装)"""
+    return datetime.strptime(dt.replace('(JST)', ' +0900'),
+                             '%Y-%m-%d %H:%M:%S %z')
+
+
+TIMESTAMPS = [
+    # LC_wrapperの書式
+    '2024-10-18 19:32:54(JST)',
+    '2024-10-18 19:32:54 (JST)',
+    # 日付の変わり目・うるう日・年末
+    '2024-10-18 00:00:00(JST)',
+    '2024-02-29 23:59:59(JST)',
+    '2024-12-31 23:59:59(JST)',
+    # strptimeで変換する書式
+    '2024-10-18 19:32:54  (JST)',
+    '2024-1-8 9:32:54(JST)',
+]
+
+
+@pytest.fixture(params=['UTC', 'Asia/Tokyo', 'America/New_York'])
+def local_timezone(request, monkeypatch):
+    """プロセスのタイムゾーンを変更する"""
+    monkeypatch.setenv('TZ', request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.mark.parametrize('dt', TIMESTAMPS)
+def test_jst2datetime_matches_strptime(dt, local_timezone):
+    converted = jst2datetime(dt)
+    assert converted == jst2datetime_strptime(dt)
+    assert converted.utcoffset() == timedelta(hours=9)
+
+
+def test_jst2datetime_compares_with_other_timezones():
+    converted = jst2datetime('2024-10-18 09:00:00(JST)')
+    assert converted == datetime(2024, 10, 18, 0, 0, 0, tzinfo=timezone.utc)
+    assert converted.astimezone(timezone(timedelta(hours=-4))) \
+        == datetime(2024, 10, 17, 20, 0, 0, tzinfo=timezone(timedelta(hours=-4)))
+
+
+@pytest.mark.parametrize('dt', ['2024-10-18 19:32:54', '2024-10-18T19:32:54(JST)'])
+def test_jst2datetime_rejects_other_formats(dt):
+    with pytest.raises(ValueError):
+        jst2datetime_strptime(dt)
+    with pytest.raises(ValueError):
+        jst2datetime(dt)
@@ -0,0 +1,43 @@
+from unittest import mock
+
+from ldap3 import MOCK_SYNC, OFFLINE_SLAPD_2_4, Connection, Server
+import pytest
+
+import utils
+
+
+@pytest.fixture
+def ldap_client():
+    """People配下にユーザを登録したモックのLDAPサーバに接続するldapClient"""
+    server = Server('mock', get_info=OFFLINE_SLAPD_2_4)
+
+    manager_dn = 'cn=Manager,dc=jupyterhub,dc=server,dc=sample,dc=jp'
+
+    def connect(pool):
+        conn = Connection(server, manager_dn, 'password',
+                          client_strategy=MOCK_SYNC, raise_exceptions=True)
+        conn.strategy.add_entry(manager_dn, {'userPassword': 'password'})
+        users = [('Student01', ['Student01'], 1001),
+                 ('student02', ['student02', 'Student02-alias'], 1002)]
+        for name, uids, uid_number in users:
+            conn.strategy.add_entry(
+                f'uid={name},{utils.ldapClient.ldap_base_dn}',
+                {'objectClass': ['posixAccount'], 'uid': uids,
+                 'uidNumber': uid_number})
+        conn.bind()
+        return conn
+
+    with mock.patch.object(utils.LdapConnectionPool, '_connect', connect):
+        client = utils.ldapClient('mock', 'cn=test', 'password')
+        yield client
+        client.pool.close()
+
+
+def test_search_users_keys_are_case_insensitive(ldap_client):
+    entries = ldap_client.search_users(['student01', 'STUDENT02', 'unknown'],
+                                       ['uidNumber'])
+    assert entries['student01'].uidNumber.value == 1001
+    # uidが複数の値を持つ場合は、いずれの値でも引ける
+    assert entries['student02'].uidNumber.value == 1002
+    assert entries['student02-alias'].uidNumber.value == 1002
+    assert 'unknown' not in entries
@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta, timezone
+import json
+import os
+
+from nbgrader.api import Gradebook
+import pytest
+from sqlmodel import Session, select
+
+import handlers
+from models import LatestLog, get_engine
+
+JST = timezone(timedelta(hours=9))
+TEACHER = 'teacher01'
+STUDENT = 'student01'
+COURSE = 'course01'
+ASSIGNMENT = 'assignment01'
+NOTEBOOK = 'notebook01.ipynb'
+CELL_ID = 'cd9eab9a-90e4-11ef-aad1-02420a010038'
+
+
+def make_log(end: str, status: str = 'ok') -> dict:
+    return {
+        'code': 'print(1)',
+        'path': f'{ASSIGNMENT}/.log/{CELL_ID}/{CELL_ID}.json',
+        'start': end,
+        'end': end,
+        'size': 1.0,
+        'server_signature': 'signature',
+        'uid': 1001,
+        'gid': 100,
+        'notebook_path': f'{ASSIGNMENT}/{NOTEBOOK}',
+        'lc_notebook_meme': 'meme',
+        'execute_reply_status': status,
+    }
+
+
+def write_logs(path: str, logs: list):
+    # LC_wrapperと同様にJSON配列として出力する
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(logs, f, indent=1)
+
+
+@pytest.fixture
+def homedir(tmp_path, monkeypatch):
+    """教師1人・学生1人・セル1つの課題を持つコースのホームディレクトリ"""
+    monkeypatch.delenv('LOG_DB_URL', raising=False)
+    course_path = tmp_path / TEACHER / 'nbgrader' / COURSE
+    release_path = course_path / 'release' / ASSIGNMENT
+    release_path.mkdir(parents=True)
+    with Gradebook(f'sqlite:///{course_path / "gradebook.db"}', COURSE) as gb:
+        gb.add_assignment(ASSIGNMENT)
+        gb.add_student(STUDENT)
+
+    notebook = {
+        'cells': [{
+            'cell_type': 'code',
+            'execution_count': 1,
+            'id': '4855ae0b',
+            'metadata': {'lc_cell_meme': {'current': CELL_ID}},
+            'outputs': [],
+            'source': ['print(1)'],
+        }],
+        'metadata': {},
+        'nbformat': 4,
+        'nbformat_minor': 5,
+    }
+    (release_path / NOTEBOOK).write_text(json.dumps(notebook))
+
+    student_assign_path = tmp_path / STUDENT / COURSE / ASSIGNMENT
+    (student_assign_path / '.log' / CELL_ID).mkdir(parents=True)
+    (student_assign_path / NOTEBOOK).write_text(json.dumps(notebook))
+    return str(tmp_path)
+
+
+def log_path(homedir: str) -> str:
+    return os.path.join(homedir, STUDENT, COURSE, ASSIGNMENT, '.log',
+                        CELL_ID, CELL_ID + '.json')
+
+
+def test_log2db_does_not_reread_logs_before_dt_from(homedir):
+    logs = [make_log('2024-10-18 10:00:00(JST)'),
+            make_log('2024-10-18 11:00:00(JST)'),
+            make_log('2024-10-18 13:00:00(JST)')]
+    write_logs(log_path(homedir), logs)
+    dt_from = datetime(2024, 10, 18, 12, 0, 0, tzinfo=JST)
+
+    progress = dict()
+    handlers.log2db(COURSE, TEACHER, homedir=homedir, dt_from=dt_from,
+                    progress=progress)
+    assert progress['files_read'] == 1
+    assert progress['logs'] == 1
+
+    # 変更の無いログファイルは読み取らない
+    progress = dict()
+    handlers.log2db(COURSE, TEACHER, homedir=homedir, dt_from=dt_from,
+                    progress=progress)
+    assert progress['files_scanned'] == 1
+    assert progress['files_read'] == 0
+    assert progress['logs'] == 0
+
+    # 追記されたログのみを読み取る
+    write_logs(log_path(homedir),
+               logs + [make_log('2024-10-18 14:00:00(JST)', 'error')])
+    progress = dict()
+    handlers.log2db(COURSE, TEACHER, homedir=homedir, dt_from=dt_from,
+                    progress=progress)
+    assert progress['files_read'] == 1
+    assert progress['logs'] == 1
+
+
+def test_log2db_resets_latest_log_when_file_is_recreated(homedir):
+    write_logs(log_path(homedir),
+               [make_log('2024-10-18 10:00:00(JST)'),
+                make_log('2024-10-18 11:00:00(JST)'),
+                make_log('2024-10-18 12:00:00(JST)', 'error')])
+    log_db_url = handlers.log2db(COURSE, TEACHER, homedir=homedir)
+
+    # ログファイルを削除し、作り直す
+    os.remove(log_path(homedir))
+    write_logs(log_path(homedir), [make_log('2024-10-18 13:00:00(JST)')])
+    handlers.log2db(COURSE, TEACHER, homedir=homedir)
+
+    with Session(get_engine(log_db_url)) as session:
+        latest_logs = session.exec(select(LatestLog)).all()
+    assert [(latest.log_sequence, latest.log_execute_reply_status)
+            for latest in latest_logs] == [(0, 'ok')]
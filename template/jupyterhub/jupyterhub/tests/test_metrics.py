@@ -0,0 +1,42 @@
+from unittest import mock
+
+from tornado import web
+from tornado.testing import AsyncHTTPTestCase
+
+import handlers
+import lms_client
+import lti
+
+
+class MetricsHandler(handlers.TeacherToolsMetricsHandler):
+
+    def get_current_user(self):
+        return {'name': 'teacher01'}
+
+
+class TestMetrics(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return web.Application(
+            [(r'/metrics', MetricsHandler)],
+            hub_api_url='',
+            homedir='',
+        )
+
+    def test_lms_requests_are_exposed(self):
+        client = lms_client.configure_lms_client(pool_maxsize=32)
+        response = mock.Mock(status_code=500, text='')
+        with mock.patch.object(client.session, 'request',
+                               return_value=response), \
+             mock.patch.object(lti, 'create_lti_jwt', return_value='jwt'):
+            # LTIのトークン取得も同じLmsClientで行い、metricsに記録される
+            with self.assertRaises(Exception):
+                lti.request_lms_lti_token(
+                    'scope', 'https://hub.example.com', None,
+                    'https://lms.example.com/mod/lti/token.php', 'client')
+        assert lms_client.get_lms_client() is client
+
+        response = self.fetch('/metrics')
+        assert response.code == 200
+        body = response.body.decode()
+        assert 'mcj_lms_request_errors_total{endpoint="https://lms.example.com/mod/lti/token.php",method="POST"}' in body
@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import pytest
+
+from utils import TTLCache
+
+
+def test_get_or_load_shares_concurrent_load():
+    cache = TTLCache(60)
+    calls = []
+    started = threading.Event()
+
+    def loader():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return 'value'
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        first = executor.submit(cache.get_or_load, 'key', loader)
+        started.wait()
+        others = [executor.submit(cache.get_or_load, 'key', loader)
+                  for _ in range(7)]
+        results = [first.result()] + [f.result() for f in others]
+
+    assert results == ['value'] * 8
+    assert len(calls) == 1
+    assert cache._load_locks == {}
+
+
+def test_get_or_load_removes_lock_when_loader_fails():
+    cache = TTLCache(60)
+
+    def loader():
+        raise RuntimeError('failed')
+
+    for i in range(3):
+        with pytest.raises(RuntimeError):
+            cache.get_or_load(f'key{i}', loader)
+    assert cache._load_locks == {}
+    assert cache.get_or_load('key0', lambda: 'value') == 'value'
+    assert cache._load_locks == {}
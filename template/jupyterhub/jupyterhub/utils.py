@@ -1,61 +1,380 @@
+from contextlib import contextmanager
 import copy
+from datetime import datetime, timezone
+import json
+import logging
+import queue
+import threading
+import time
 
-from ldap3 import Server, Connection, ALL, MODIFY_REPLACE
-from ldap3.core.exceptions import LDAPNoSuchObjectResult
+from ldap3 import Connection, LEVEL
+from ldap3.core.exceptions import (LDAPCommunicationError, LDAPException,
+                                   LDAPNoSuchObjectResult)
+from ldap3.utils.conv import escape_filter_chars
 
-class ldapClient():
-    ldap_base_dn = 'ou=People,dc=jupyterhub,dc=server,dc=sample,dc=jp'
-    def __init__(self, host, manager_dn, password):
-        self.server = Server(host, get_info=ALL)
-        self.conn = Connection(
-            host,
-            manager_dn,
-            password=password,
+
+class SuppressedCountMixin():
+    """RateLimitFilterにより出力しなかった件数(suppressed属性)を、ログの1行目の末尾に付ける
+
+    logging.Formatterのサブクラスと組み合わせて使う。
+    """
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if not suppressed:
+            return text
+        first_line, sep, rest = text.partition('\n')
+        return f'{first_line} (suppressed: {suppressed}){sep}{rest}'
+
+
+class TextFormatter(SuppressedCountMixin, logging.Formatter):
+    """ログをテキストで出力する"""
+
+
+class JsonFormatter(logging.Formatter):
+    """ログを1行1件のJSONで出力する"""
+
+    def format(self, record):
+        entry = dict(
+            time=datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            level=record.levelname,
+            logger=record.name,
+            module=record.module,
+            func=record.funcName,
+            line=record.lineno,
+            message=record.getMessage(),
+        )
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """同じ箇所から出力されるログを、period秒あたりmax_records件までに制限する
+
+    levelより重要度の高いログは制限しない。max_recordsが0以下の場合は制限しない。
+    制限により出力しなかった件数は、次の期間で最初に出力するログのsuppressed属性に付与する。
+    """
+
+    def __init__(self, period: float = 60, max_records: int = 100,
+                 level: int | str = logging.WARNING):
+        super().__init__()
+        self.period = period
+        self.max_records = max_records
+        self.level = level if isinstance(level, int) \
+            else logging.getLevelName(level.upper())
+        self._windows = dict()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.level or self.max_records <= 0:
+            return True
+
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            # [期間の開始時刻, 出力した件数, 出力しなかった件数]
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                if window is not None and window[2] > 0:
+                    record.suppressed = window[2]
+                window = [now, 0, 0]
+                self._windows[key] = window
+            if window[1] >= self.max_records:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+
+class TTLCache():
+    """有効期限付きのキャッシュ
+
+    複数スレッドから利用できる。有効期限切れのエントリは参照時に削除する。
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._data = dict()
+        self._lock = threading.Lock()
+        self._load_locks = dict()
+
+    def _get_item(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[1] < time.monotonic():
+                del self._data[key]
+                return None
+            return item
+
+    def get(self, key, default=None):
+        item = self._get_item(key)
+        return item[0] if item is not None else default
+
+    def set(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            self._data[key] = (value, now + self.ttl, now)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item is not None else default
+
+    def get_or_load(self, key, loader, force: bool = False):
+        """キャッシュの値を返す。無ければloader()で取得して格納する
+
+        同じキーの取得が実行中の場合は新たに取得せず、その完了を待って結果を共有する。
+        forceがTrueの場合は、呼び出し以降に取得された値のみを利用する。
+
+        :param key: キー
+        :param loader: 値を取得する関数
+        :type loader: callable
+        :param force: キャッシュを使わずに取得し直すか
+        :type force: bool
+        """
+        requested_at = time.monotonic()
+        if not force:
+            item = self._get_item(key)
+            if item is not None:
+                return item[0]
+
+        # キーごとの[ロック, 待機中のスレッド数]。待機中のスレッドが無くなったら削除する
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, [threading.Lock(), 0])
+            load_lock[1] += 1
+        try:
+            with load_lock[0]:
+                with self._lock:
+                    item = self._data.get(key)
+                # 待機中に他のスレッドが取得した値は、有効期限によらず共有する
+                if item is not None and (item[2] >= requested_at or
+                                         (not force and item[1] >= time.monotonic())):
+                    return item[0]
+                value = loader()
+                self.set(key, value)
+                return value
+        finally:
+            with self._lock:
+                load_lock[1] -= 1
+                if load_lock[1] == 0:
+                    self._load_locks.pop(key, None)
+
+
+class LdapConnectionPool():
+    """bind済みのldap3 Connectionを使い回すためのプール
+
+    最大size本のConnectionを保持する。取り出したConnectionが
+    health_check_interval秒以上使われていなかった場合はWho am I?で疎通を確認し、
+    応答が無ければ作り直す。close()後は、使用中のConnectionも返却時にunbindする。
+    """
+
+    def __init__(self, host, manager_dn, password, size: int = 10,
+                 health_check_interval: float = 30):
+        self.host = host
+        self.manager_dn = manager_dn
+        self.password = password
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self.closed = False
+
+    def _connect(self) -> Connection:
+        conn = Connection(
+            self.host,
+            self.manager_dn,
+            password=self.password,
             read_only=False,
             raise_exceptions=True,
         )
+        conn.bind()
+        return conn
 
-    def search_user(self, username, attributes: list = None):
-        self.conn.bind()
+    def _is_alive(self, conn: Connection) -> bool:
+        if conn.closed or not conn.bound:
+            return False
         try:
-            self.conn.search(
-                f'uid={username},{self.ldap_base_dn}',
-                '(objectClass=*)',
-                attributes=attributes,
-            )
-            return copy.deepcopy(self.conn.entries)
-        except LDAPNoSuchObjectResult:
-            return
-        finally:
-            try:
-                self.conn.unbind()
-            except Exception:
-                pass
+            conn.extend.standard.who_am_i()
+        except LDAPException:
+            return False
+        return True
 
-    def add_user(self, dn, object_class=None, attributes=None):
-        self.conn.bind()
+    def _discard(self, conn: Connection):
         try:
-            self.conn.add(
-                dn,
-                object_class,
-                attributes,
-            )
-        finally:
+            conn.unbind()
+        except Exception:
+            pass
+
+    def _acquire(self) -> Connection:
+        self._slots.acquire()
+        try:
+            conn, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            if time.monotonic() - last_used < self.health_check_interval \
+               or self._is_alive(conn):
+                return conn
+            self._discard(conn)
+
+        try:
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, conn: Connection | None):
+        if conn is not None:
+            if self.closed:
+                self._discard(conn)
+            else:
+                self._idle.put((conn, time.monotonic()))
+                if self.closed:
+                    # close()と同時に返却された場合の取りこぼしを防ぐ
+                    self._discard_idle()
+        self._slots.release()
+
+    def _discard_idle(self):
+        while True:
             try:
-                self.conn.unbind()
-            except Exception:
-                pass
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
 
-    def update_user(self, user_name: str, params: dict):
-        self.conn.bind()
+    def close(self):
+        """保持しているConnectionをunbindする
+
+        使用中のConnectionは返却時にunbindする。
+        """
+        self.closed = True
+        self._discard_idle()
+
+    @contextmanager
+    def connection(self):
+        """Connectionを取り出す
+
+        通信エラーが発生したConnectionはプールに戻さずに破棄する。
+        """
+        conn = self._acquire()
         try:
-            self.conn.modify(
-                f'uid={user_name},{self.ldap_base_dn}',
-                params,
-            )
+            yield conn
+        except LDAPCommunicationError:
+            self._discard(conn)
+            conn = None
+            raise
         finally:
+            self._release(conn)
+
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def get_ldap_pool(host, manager_dn, password, size: int = 10) -> LdapConnectionPool:
+    """接続先・bind DNごとに、プロセス内で共有するプールを返す
+
+    パスワードが変わった場合は、古いプールのConnectionをunbindして作り直す。
+    """
+    with _pools_lock:
+        pool = _pools.get((host, manager_dn))
+        if pool is None or pool.password != password:
+            if pool is not None:
+                pool.close()
+            pool = LdapConnectionPool(host, manager_dn, password, size=size)
+            _pools[(host, manager_dn)] = pool
+        return pool
+
+
+class ldapClient():
+    ldap_base_dn = 'ou=People,dc=jupyterhub,dc=server,dc=sample,dc=jp'
+
+    def __init__(self, host, manager_dn, password):
+        self.pool = get_ldap_pool(host, manager_dn, password)
+
+    def _execute(self, operation, retry: bool = False):
+        """プールのConnectionで処理を実行する
+
+        retryがTrueの場合、使い回したConnectionがサーバ側で切断されていれば
+        新しい接続で1度だけ再実行する。通信エラーの時点で更新が反映済みの
+        可能性があるため、再実行は参照系の処理のみに指定すること。
+        """
+        try:
+            with self.pool.connection() as conn:
+                return operation(conn)
+        except LDAPCommunicationError:
+            if not retry:
+                raise
+            with self.pool.connection() as conn:
+                return operation(conn)
+
+    def search_user(self, username, attributes: list = None):
+
+        def _search(conn):
             try:
-                self.conn.unbind()
-            except Exception:
-                pass
+                conn.search(
+                    f'uid={username},{self.ldap_base_dn}',
+                    '(objectClass=*)',
+                    attributes=attributes,
+                )
+            except LDAPNoSuchObjectResult:
+                return
+            return copy.deepcopy(conn.entries)
 
+        return self._execute(_search, retry=True)
+
+    def search_users(self, usernames: list, attributes: list = None,
+                     chunk_size: int = 100) -> dict:
+        """複数のユーザをまとめて検索する
+
+        chunk_size人ずつ、uidのOR条件で検索する。
+        LDAPのuidは大文字・小文字を区別せずに一致するため、結果のキーは小文字にしたuidとする。
+        uidが複数の値を持つエントリは、それぞれの値をキーとする。
+
+        :param usernames: ユーザ名リスト
+        :type usernames: list
+        :param attributes: 取得する属性
+        :type attributes: list
+        :returns: 小文字にしたuidをキーとしたエントリ。存在しないユーザは含まない
+        :rtype: dict
+        """
+        _attributes = list(attributes) if attributes is not None else []
+        if 'uid' not in _attributes:
+            _attributes.append('uid')
+
+        def _search(conn):
+            entries = dict()
+            for i in range(0, len(usernames), chunk_size):
+                uid_filter = ''.join(
+                    [f'(uid={escape_filter_chars(username)})'
+                     for username in usernames[i:i + chunk_size]])
+                conn.search(
+                    self.ldap_base_dn,
+                    f'(&(objectClass=posixAccount)(|{uid_filter}))',
+                    search_scope=LEVEL,
+                    attributes=_attributes,
+                )
+                for entry in copy.deepcopy(conn.entries):
+                    for uid in entry.uid.values:
+                        entries[str(uid).lower()] = entry
+            return entries
+
+        return self._execute(_search, retry=True)
+
+    def add_user(self, dn, object_class=None, attributes=None):
+        self._execute(lambda conn: conn.add(
+            dn,
+            object_class,
+            attributes,
+        ))
+
+    def update_user(self, user_name: str, params: dict):
+        self._execute(lambda conn: conn.modify(
+            f'uid={user_name},{self.ldap_base_dn}',
+            params,
+        ))
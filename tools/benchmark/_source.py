@@ -0,0 +1,40 @@
+"""ベンチマーク対象のソースファイルから、指定した定義のみを読み込む
+
+jupyterhub_config.py や service_teachertools/handlers.py は、JupyterHubの設定として
+読み込まれる前提であったり、JupyterHub・nbgraderなどに依存したりするため、
+モジュールとしてimportせず、計測対象の定義のみを実行する。
+"""
+import ast
+
+
+def _name(node) -> str | None:
+    if isinstance(node, ast.FunctionDef):
+        return node.name
+    if isinstance(node, ast.Assign) and len(node.targets) == 1 \
+       and isinstance(node.targets[0], ast.Name):
+        return node.targets[0].id
+    return None
+
+
+def load_definitions(path: str, names: tuple, namespace: dict) -> dict:
+    """ソースファイルのトップレベルの関数・変数の定義のうち、namesのみを実行する
+
+    :param path: ソースファイルのパス
+    :type path: str
+    :param names: 読み込む関数名・変数名
+    :type names: tuple
+    :param namespace: 定義が参照するモジュールなど。読み込んだ定義が追加される
+    :type namespace: dict
+    :returns: namespace
+    :rtype: dict
+    """
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    body = [node for node in tree.body if _name(node) in names]
+    missing = set(names) - {_name(node) for node in body}
+    if missing:
+        raise RuntimeError(f'Not found in {path}: {sorted(missing)}')
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, 'exec'),
+         namespace)
+    return namespace
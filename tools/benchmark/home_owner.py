@@ -0,0 +1,141 @@
+"""ホームディレクトリの所有者確認(has_owner_drift)・変更(change_owner)の処理時間を計測する
+
+--files件(既定100,000件)のファイルを持つホームディレクトリを作成し、以下を計測する。
+
+- has_owner_drift: 所有者が一致している場合(通常のログイン時)
+- change_owner: 所有者が一致している場合(全件を走査し、chownは行わない)
+- chown -R: 従来のCHOWN_EXTRA_OPTS=-Rと同等の処理
+- 所有者がずれている場合のhas_owner_drift・change_owner(rootで実行した場合のみ)
+
+has_owner_drift・change_ownerは jupyterhub_config.py に定義されたものを読み込んで使う。
+NFS上で計測する場合は --path にNFSのマウント先のディレクトリを指定すること。
+
+e.g.
+    python home_owner.py --files 100000 --path /jupyter/users
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from _source import load_definitions
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '../../template/jupyterhub/jupyterhub/jupyterhub_config.py')
+TARGET_NAMES = ('OWNER_DRIFT_SAMPLE_SIZE', 'change_owner', 'has_owner_drift')
+
+
+def load_functions() -> dict:
+    """jupyterhub_config.py から計測対象の定義のみを読み込む"""
+    return load_definitions(CONFIG_PATH, TARGET_NAMES,
+                            dict(os=os, random=random))
+
+
+def create_home(path: str, files: int, dirs: int, file_size: int):
+    """dirs個のディレクトリ(2階層)にfiles件のファイルを分散して作成する"""
+    data = b'x' * file_size
+    per_dir = max(1, files // dirs)
+    created = 0
+    for i in range(dirs):
+        d = os.path.join(path, f'dir{i // 10:03d}', f'sub{i:04d}')
+        os.makedirs(d, exist_ok=True)
+        for j in range(min(per_dir, files - created)):
+            with open(os.path.join(d, f'file{j:05d}.txt'), 'wb') as f:
+                f.write(data)
+        created += per_dir
+        if created >= files:
+            break
+
+
+def measure(label: str, func, *args, repeat: int = 1):
+    elapsed = list()
+    result = None
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = func(*args)
+        elapsed.append(time.perf_counter() - started_at)
+    print(f'{label:<40} best={min(elapsed):.4f}s '
+          f'worst={max(elapsed):.4f}s result={result}')
+    return result
+
+
+def drop_caches():
+    """ページキャッシュ・inodeキャッシュを破棄する(rootの場合のみ)"""
+    if os.geteuid() != 0:
+        return
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+    except OSError:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--dirs', type=int, default=1000)
+    parser.add_argument('--file-size', type=int, default=0)
+    parser.add_argument('--path', default=None,
+                        help='ホームディレクトリを作成するディレクトリ。既定は一時ディレクトリ')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cold', action='store_true',
+                        help='計測ごとにキャッシュを破棄する(rootの場合のみ)')
+    parser.add_argument('--keep', action='store_true',
+                        help='作成したホームディレクトリを削除しない')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    functions = load_functions()
+    change_owner = functions['change_owner']
+    has_owner_drift = functions['has_owner_drift']
+
+    home = tempfile.mkdtemp(prefix='bench-home-', dir=args.path)
+    try:
+        started_at = time.perf_counter()
+        create_home(home, args.files, args.dirs, args.file_size)
+        print(f'created {args.files} files in {args.dirs} dirs: {home} '
+              f'({time.perf_counter() - started_at:.1f}s)')
+        uid, gid = os.getuid(), os.getgid()
+
+        def _run(label, func, *func_args):
+            if args.cold:
+                for _ in range(args.repeat):
+                    drop_caches()
+                    measure(label, func, *func_args)
+            else:
+                measure(label, func, *func_args, repeat=args.repeat)
+
+        _run('has_owner_drift (no drift)', has_owner_drift, home, uid, gid)
+        _run('change_owner (no drift)', change_owner, home, uid, gid)
+        _run('chown -R (previous behavior)', subprocess.check_call,
+             ['chown', '-R', f'{uid}:{gid}', home])
+
+        if os.geteuid() != 0:
+            print('skip drift cases: run as root to change file owners')
+            return
+
+        drifted_uid = uid + 1
+        for name in sorted(os.listdir(home)):
+            # 2階層目の一部のディレクトリのみ所有者をずらす
+            subdirs = sorted(os.listdir(os.path.join(home, name)))
+            for subdir in subdirs[::max(1, len(subdirs) // 2)]:
+                subprocess.check_call(
+                    ['chown', '-R', f'{drifted_uid}:{gid}',
+                     os.path.join(home, name, subdir)])
+        measure('has_owner_drift (drift)', has_owner_drift, home, uid, gid,
+                repeat=args.repeat)
+        measure('change_owner (drift)', change_owner, home, uid, gid)
+        measure('has_owner_drift (after change_owner)', has_owner_drift,
+                home, uid, gid, repeat=args.repeat)
+    finally:
+        if not args.keep:
+            shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    main()
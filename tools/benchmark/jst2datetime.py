@@ -0,0 +1,70 @@
+"""LC_wrapperのタイムスタンプの変換(jst2datetime)と、従来のstrptimeによる変換の処理時間を比較する
+
+jst2datetimeは service_teachertools/handlers.py に定義されたものを読み込んで使う。
+計測前に、両者の変換結果が一致することを確認する。
+
+e.g.
+    python jst2datetime.py --number 100000
+"""
+import argparse
+from datetime import datetime, timedelta, timezone
+import os
+import random
+import re
+import timeit
+
+from _source import load_definitions
+
+HANDLERS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '../../template/jupyterhub/jupyterhub/service_teachertools/handlers.py')
+TARGET_NAMES = ('JST', 'JST_TIMESTAMP_PATTERN', 'jst2datetime')
+
+
+def load_functions() -> dict:
+    """handlers.py から計測対象の定義のみを読み込む"""
+    return load_definitions(HANDLERS_PATH, TARGET_NAMES,
+                            dict(datetime=datetime, timedelta=timedelta,
+                                 timezone=timezone, re=re))
+
+
+def jst2datetime_strptime(dt: str) -> datetime:
+    """変更前のjst2datetime"""
+    return datetime.strptime(dt.replace('(JST)', ' +0900'),
+                             '%Y-%m-%d %H:%M:%S %z')
+
+
+def make_timestamps(size: int) -> list:
+    start = datetime(2024, 4, 1, 9, 0, 0)
+    return [(start + timedelta(seconds=random.randrange(365 * 24 * 3600)))
+            .strftime('%Y-%m-%d %H:%M:%S(JST)')
+            for _ in range(size)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=100000,
+                        help='1回の計測で変換するタイムスタンプの件数')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    jst2datetime = load_functions()['jst2datetime']
+    timestamps = make_timestamps(args.number)
+    for dt in timestamps[:1000]:
+        assert jst2datetime(dt) == jst2datetime_strptime(dt), dt
+
+    results = dict()
+    for label, func in (('strptime', jst2datetime_strptime),
+                        ('jst2datetime', jst2datetime)):
+        elapsed = min(timeit.repeat(lambda: [func(dt) for dt in timestamps],
+                                    repeat=args.repeat, number=1))
+        results[label] = elapsed
+        print(f'{label:<14} {elapsed:.4f}s / {args.number} '
+              f'({elapsed / args.number * 1e6:.2f} us/call)')
+    print(f'speedup: {results["strptime"] / results["jst2datetime"]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""spawn時のLDAP処理(confirm_ldap_user)のレイテンシを同時ログイン数を変えて計測する
+
+ログインごとに、ユーザの検索と(登録済みであれば)gidNumberの更新を行う。
+--mode pooled は utils.ldapClient(プロセス内で共有するConnectionプール)、
+--mode unpooled は処理ごとに bind/unbind する従来の方式で計測する。
+
+検索・更新の対象は --user-prefix に連番を付けたユーザ。
+存在しないユーザは検索のみ行う(登録はしない)ため、検証用のLDAPサーバに対して実行すること。
+
+e.g.
+    python ldap_spawn_hook.py --host ldap://localhost:389 \\
+        --manager-dn cn=Manager,dc=jupyterhub,dc=server,dc=sample,dc=jp \\
+        --password-env LDAP_PASSWORD --concurrency 200 --mode pooled
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import statistics
+import sys
+import threading
+import time
+
+from ldap3 import Connection, MODIFY_REPLACE
+from ldap3.core.exceptions import LDAPNoSuchObjectResult
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../../template/jupyterhub/jupyterhub'))
+from utils import ldapClient  # noqa: E402
+
+
+class UnpooledClient():
+    """処理ごとにbind/unbindする(プール導入前のldapClientと同等)"""
+
+    ldap_base_dn = ldapClient.ldap_base_dn
+
+    def __init__(self, host, manager_dn, password):
+        self.host = host
+        self.manager_dn = manager_dn
+        self.password = password
+
+    def _connect(self):
+        conn = Connection(self.host, self.manager_dn, password=self.password,
+                          read_only=False, raise_exceptions=True)
+        conn.bind()
+        return conn
+
+    def search_user(self, username, attributes: list = None):
+        conn = self._connect()
+        try:
+            conn.search(f'uid={username},{self.ldap_base_dn}',
+                        '(objectClass=*)', attributes=attributes)
+        except LDAPNoSuchObjectResult:
+            return
+        finally:
+            conn.unbind()
+        return conn.entries
+
+    def update_user(self, user_name: str, params: dict):
+        conn = self._connect()
+        try:
+            conn.modify(f'uid={user_name},{self.ldap_base_dn}', params)
+        finally:
+            conn.unbind()
+
+
+def login(client_factory, username: str, start: threading.Barrier) -> float:
+    start.wait()
+    started_at = time.perf_counter()
+    client = client_factory()
+    entries = client.search_user(username, ['uidNumber', 'gidNumber'])
+    if entries:
+        gid_num = entries[0].gidNumber.value
+        client.update_user(username,
+                           {'gidNumber': [(MODIFY_REPLACE, [gid_num])]})
+    return time.perf_counter() - started_at
+
+
+def run(args, client_factory) -> list:
+    start = threading.Barrier(args.concurrency)
+    usernames = [f'{args.user_prefix}{i:04d}' for i in range(args.concurrency)]
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        return list(executor.map(
+            lambda username: login(client_factory, username, start),
+            usernames))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', required=True)
+    parser.add_argument('--manager-dn', required=True)
+    parser.add_argument('--password-env', default='LDAP_PASSWORD',
+                        help='bind用パスワードを設定した環境変数名')
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--user-prefix', default='bench-user')
+    parser.add_argument('--mode', choices=['pooled', 'unpooled'],
+                        default='pooled')
+    args = parser.parse_args()
+    password = os.environ[args.password_env]
+
+    if args.mode == 'pooled':
+        def client_factory():
+            return ldapClient(args.host, args.manager_dn, password)
+    else:
+        def client_factory():
+            return UnpooledClient(args.host, args.manager_dn, password)
+
+    for i in range(args.rounds):
+        started_at = time.perf_counter()
+        latencies = sorted(run(args, client_factory))
+        elapsed = time.perf_counter() - started_at
+        print(f'[{args.mode}] round {i + 1}: '
+              f'logins={len(latencies)} total={elapsed:.3f}s '
+              f'p50={statistics.median(latencies) * 1000:.1f}ms '
+              f'p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms '
+              f'max={latencies[-1] * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()